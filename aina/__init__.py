@@ -6,4 +6,10 @@ __author__ = """iLoveTux"""
 __email__ = 'cliffbressette@gmail.com'
 __version__ = '0.1.2'
 
-from aina.render import render
+from aina.render import (
+    render,
+    render_iter,
+    compile_template,
+    load_template,
+    Template,
+)
@@ -19,69 +19,34 @@ templated file and directory names).
 """
 import os
 import sys
-import runpy
 import click
 import logging
-from pathlib import Path
-from aina.render import render
-from glob import glob
-from time import time, sleep
+from aina.render import TRACE
+from aina.output import DEFAULT_FLUSH_BYTES
+# Whatever only one of the subcommands needs is imported by that
+# subcommand, aina is often run many times in a row so the time
+# it takes to start matters.
 cli = click.Group()
 
-def _exec_list(exprs, namespace):
-    log = logging.getLogger(__name__)
-    for expr in exprs:
-        _expr = render(expr, namespace)
-        if os.path.isfile(_expr):
-            log.debug("{} is a file, executing...".format(_expr))
-            namespace.update(runpy.run_path(_expr, init_globals=namespace))
-        else:
-            log.debug("Executing {}".format(_expr))
-            exec(_expr, namespace)
-
-def make_namespace(namespace, namespaces, add_env):
-    if add_env:
-        namespace.update(os.environ)
-    if namespaces is not None:
-        for _namespace in namespaces:
-            with open(_namespace, "r") as fin:
-                namespace.update(eval(fin.read(), namespace))
-    return namespace
-
-def render_directory(src, dst, recursive, namespace):
-    log = logging.getLogger(__name__)
-    src = Path(render(src, namespace))
-    dst = Path(render(dst, namespace))
-    for root, dirs, filenames in os.walk(str(src), topdown=True):
-        log.debug("In directory: {}".format(root))
-        for filename in filenames:
-            filename = Path(os.path.join(root, filename))
-            log.debug("Found file {}".format(filename))
-            _dst = os.path.join(str(dst), os.path.relpath(str(filename), str(src)))
-            render_file(filename, _dst, namespace)
-        if recursive:
-            for dirname in dirs:
-                new_dir = Path(dst / dirname)
-                log.debug("Recursive, rendering to {}".format(new_dir))
-                new_dir.mkdir(parents=True, exist_ok=True)
-        else:
-            log.debug("Not recursive, exiting")
-            dirs.clear()
+def configure_logging(
+    logging_config, logging_level, logging_format, trace=False,
+):
+    """Configure logging with the dictConfig in the file
+    `logging_config` or, if not given, to write to stdout. With
+    `trace`, everything down to the `TRACE` level is logged."""
+    if logging_config:
+        from logging.config import dictConfig
 
-mtimes = {}
-def render_file(src, dst, namespace):
-    log = logging.getLogger(__name__)
-    dst = Path(dst)
-    src = Path(src)
-    if src not in mtimes or src.stat().st_mtime != mtimes[src]:
-        log.warn("Rendering {} -> {}".format(src, dst))
-        try:
-            dst.write_text(render(src.read_text(), namespace))
-        finally:
-            mtimes[src] = src.stat().st_mtime
+        with open(logging_config, "r") as fp:
+            dictConfig(eval(fp.read()))
     else:
-        log.debug("File {} has not changed, skipping".format(src))
-        pass
+        logging.basicConfig(
+            stream=sys.stdout,
+            level=logging_level,
+            format=logging_format,
+        )
+    if trace:
+        logging.getLogger().setLevel(TRACE)
 
 @cli.command("doc")
 @click.argument("src")
@@ -92,9 +57,16 @@ def render_file(src, dst, namespace):
 @click.option("--add-env", "-E", default=False, is_flag=True)
 @click.option("--begins", "-b", multiple=True)
 @click.option("--ends", "-e", multiple=True)
+@click.option("--rescan", is_flag=True, default=False)
+@click.option("--debounce", default=50, type=int)
+@click.option("--poll", is_flag=True, default=False)
+@click.option("--cache-dir", default=None)
+@click.option("--jobs", "-j", default=1, type=int)
+@click.option("--lazy-namespaces", is_flag=True, default=False)
 @click.option("--logging-config", "-L")
 @click.option("--logging-level", default=30)
 @click.option("--logging-format", default="%(message)s")
+@click.option("--trace", is_flag=True, default=False)
 def doc(
         src,
         dst,
@@ -104,52 +76,107 @@ def doc(
         add_env,
         begins,
         ends,
+        rescan,
+        debounce,
+        poll,
+        cache_dir,
+        jobs,
+        lazy_namespaces,
         logging_config,
         logging_level,
         logging_format,
+        trace,
     ):
     """Render a set of template documents `src` to detination `dst`
     with a persistent namespace"""
-    if logging_config:
-        with open(logging_config, "r") as fp:
-            logging.config.dictConfig(eval(fp.read()))
-    else:
-        logging.basicConfig(
-            stream=sys.stdout,
-            level=logging_level,
-            format=logging_format,
-        )
+    from pathlib import Path
+    from aina.hooks import compile_hooks, exec_hooks
+    from aina.doc import (
+        dependencies,
+        prepare_namespace,
+        render_changed,
+        render_file,
+        render_parallel,
+        render_src,
+    )
+
+    configure_logging(logging_config, logging_level, logging_format, trace)
     log = logging.getLogger(__name__)
     if begins is None:
         begins = []
     if ends is None:
         ends = []
-    namespace = {}
-    _exec_list(begins, namespace)
-    namespace.update(make_namespace(namespace, namespaces, add_env))
+    ends = compile_hooks(ends)
+    dependencies.clear()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        index = os.path.join(cache_dir, "index.json")
+        if dependencies.load(index):
+            log.debug("Loaded build cache {}".format(index))
+    options = dict(
+        begins=begins,
+        namespaces=namespaces,
+        add_env=add_env,
+        rescan=rescan,
+        cache_dir=cache_dir,
+        lazy_namespaces=lazy_namespaces,
+    )
+
+    def render_all(namespace):
+        if jobs <= 1:
+            return render_src(src, dst, recursive, namespace, rescan)
+        pending = []
+        _dst = render_src(src, dst, recursive, namespace, rescan, pending)
+        errors = render_parallel(pending, jobs, options)
+        for filename, error in errors:
+            log.error("Failed to render {}\n{}".format(filename, error))
+        if errors:
+            raise click.ClickException(
+                "{} of {} files failed to render".format(
+                    len(errors), len(pending),
+                )
+            )
+        return _dst
+
+    namespace = prepare_namespace(**options)
     src, dst = map(Path, (src, dst))
     src = src.resolve()
-    while True:
-        if src.is_dir():
-            log.debug("src is directory: {}".format(src))
-            if not dst.is_dir():
-                raise ValueError("If src is a directory, dst must also be a directory")
-            render_directory(src, dst, recursive, namespace)
-        elif src.is_file():
-            log.debug("src is file: {}".format(src))
-            if dst.exists() and dst.is_dir():
-                dst = dst / src.name
-                log.debug("dst is directory, rendering to: {}".format(dst))
-            elif not dst.parent.exists():
-                log.debug("{} does not exist, creating...")
-                dst.parent.mkdir(parents=True, exist_ok=True)
-            render_file(src, dst, namespace)
-        else:
-            raise ValueError("src must be either a file or directory.")
-        if interval <= 0:
-            break
-        sleep(interval)
-    _exec_list(ends, namespace)
+    try:
+        dst = render_all(namespace)
+    finally:
+        if cache_dir is not None:
+            dependencies.save(index)
+    if interval > 0:
+        from aina.watch import watch
+
+        watcher = watch(
+            str(src), recursive, interval, debounce / 1000.0, poll,
+        )
+        log.debug("Watching {} with {}".format(src, type(watcher).__name__))
+        try:
+            while True:
+                watcher.watch_files(dependencies.inputs())
+                changed = watcher.wait()
+                if (changed.intersection(dependencies.common)
+                        and dependencies.common_changed()):
+                    log.debug(
+                        "Namespace inputs changed, preparing a new namespace"
+                    )
+                    namespace = prepare_namespace(**options)
+                    render_all(namespace)
+                else:
+                    for _dst, _src in dependencies.affected(changed):
+                        render_file(_src, _dst, namespace, rescan)
+                    for path in map(Path, sorted(changed)):
+                        if path == src or src in path.parents:
+                            render_changed(
+                                path, src, dst, recursive, namespace, rescan,
+                            )
+                if cache_dir is not None:
+                    dependencies.save(index)
+        finally:
+            watcher.close()
+    exec_hooks(ends, namespace)
     return 0
 
 
@@ -171,8 +198,30 @@ def doc(
 @click.option("--logging-config", "-L")
 @click.option("--logging-level", default=20)
 @click.option("--logging-format", default="%(message)s")
+@click.option("--trace", is_flag=True, default=False)
 @click.option("--suppress-tracebacks", is_flag=True, default=False)
 @click.option("--add-env", "-E", default=False, is_flag=True)
+@click.option("--rescan", is_flag=True, default=False)
+@click.option("--output", "-o", default=None)
+@click.option("--flush-lines", default=0, type=int)
+@click.option("--flush-bytes", default=DEFAULT_FLUSH_BYTES, type=int)
+@click.option("--jobs", "-j", default=1, type=int)
+@click.option("--chunk-size", default=0, type=int)
+@click.option("--unordered", is_flag=True, default=False)
+@click.option("--merges", multiple=True)
+@click.option("--mmap/--no-mmap", "use_mmap", default=True)
+@click.option("--batch-size", default=0, type=int)
+@click.option("--begin-batches", multiple=True)
+@click.option("--end-batches", multiple=True)
+@click.option("--cache-dir", default=None)
+@click.option("--lazy-namespaces", is_flag=True, default=False)
+@click.option("--profile", is_flag=True, default=False)
+@click.option("--profile-stats", default=None)
+@click.option("--follow", is_flag=True, default=False)
+@click.option("--follow-interval", default=0.25, type=float)
+@click.option("--follow-from-start", is_flag=True, default=False)
+@click.option("--decompress/--no-decompress", default=True)
+@click.option("--decompress-thread", is_flag=True, default=False)
 def stream(
         filenames,
         add_paths,
@@ -191,19 +240,39 @@ def stream(
         logging_config,
         logging_level,
         logging_format,
+        trace,
         suppress_tracebacks,
         add_env,
+        rescan,
+        output,
+        flush_lines,
+        flush_bytes,
+        jobs,
+        chunk_size,
+        unordered,
+        merges,
+        use_mmap,
+        batch_size,
+        begin_batches,
+        end_batches,
+        cache_dir,
+        lazy_namespaces,
+        profile,
+        profile_stats,
+        follow,
+        follow_interval,
+        follow_from_start,
+        decompress,
+        decompress_thread,
     ):
     """Pass streams of data through a processing/templating pipeline"""
-    if logging_config:
-        with open(logging_config, "r") as fp:
-            logging.config.dictConfig(eval(fp.read()))
-    else:
-        logging.basicConfig(
-            stream=sys.stdout,
-            level=logging_level,
-            format=logging_format,
-        )
+    from glob import glob, has_magic
+    from aina.output import Sink
+    from aina.stream import Pipeline, run_parallel
+    if follow:
+        from aina.follow import follow as follow_sources, is_socket
+
+    configure_logging(logging_config, logging_level, logging_format, trace)
 
     log = logging.getLogger(__name__)
     if add_paths is None:
@@ -214,7 +283,6 @@ def stream(
         else:
             log.critical("{} not found, invalid path".format(path))
             sys.exit(-2)
-    namespace = make_namespace({}, namespaces, add_env)
     if not filenames:
         log.debug("No filenames specified, defaulting to stdin")
         filenames = ["-"]
@@ -222,70 +290,86 @@ def stream(
     for filename in filenames:
         if filename == "-":
             _filenames.append("-")
+        elif follow and (is_socket(filename) or not has_magic(filename)):
+            # Followed files don't have to exist yet
+            _filenames.append(filename)
         else:
             _filenames.extend(glob(filename, recursive=recursive))
     filenames = list(filter(lambda x: not os.path.isdir(x), _filenames))
     log.debug("Reading filenames {}".format(filenames))
-    last_filename = None
-    nr = 0
-    if tests is None:
-        tests = ["True"]
-    if begins is None:
-        begins = []
-    if begin_lines is None:
-        begin_lines = []
-    if begin_files is None:
-        begin_files = []
-    if end_files is None:
-        end_files = []
-    if end_lines is None:
-        end_lines = []
-    if ends is None:
-        ends = []
-    _exec_list(begins, namespace)
-    for filename in filenames:
-        try:
-            with click.open_file(filename, "rb") as fin:
-                log.debug("Reading {}".format(filename))
-                for line in fin:
-                    log.debug("Got line: {}".format(line))
-                    if filename != last_filename:
-                        if with_filenames:
-                            print("===> {} <===".format(os.path.abspath(filename)))
-                        namespace.update({"filename": os.path.abspath(filename)})
-                        fnr = 0
-                        _exec_list(begin_files, namespace)
-                        last_filename = filename
-                    fnr, nr = fnr + 1, nr + 1
-                    fields = line.split(field_sep)
-                    namespace.update({
-                        "line": line.decode(),
-                        "filename": os.path.abspath(filename),
-                        "fields": fields,
-                        "nf": len(fields),
-                        "nr": nr,
-                        "fnr": fnr,
-                    })
-                    if all(eval(render(test, namespace), namespace) for test in tests):
-                        _exec_list(begin_lines, namespace)
-                        for template in templates:
-                            log.debug("Rendering template: {}".format(template))
-                            try:
-                                results = render(template, namespace).strip()
-                            except:
-                                if not suppress_tracebacks:
-                                    log.exception("An unhandled exception occurred")
-                                continue
-                            log.debug("Result: {}".format(results))
-                            if results:
-                                log.info(results)
-                    _exec_list(end_lines, namespace)
-            _exec_list(end_files, namespace)
-        except:
-            if not suppress_tracebacks:
-                log.exception("An unhandled exception occurred")
-            continue
-    _exec_list(ends, namespace)
+    if jobs > 1 and "-" in filenames:
+        raise click.UsageError("--jobs can not be used when reading stdin")
+    if jobs > 1 and follow:
+        raise click.UsageError("--jobs can not be used with --follow")
+    if profile_stats is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    pipeline = Pipeline(
+        templates=templates,
+        tests=tests,
+        begins=begins,
+        begin_files=begin_files,
+        begin_lines=begin_lines,
+        end_lines=end_lines,
+        end_files=end_files,
+        ends=ends,
+        field_sep=field_sep,
+        namespaces=namespaces,
+        add_env=add_env,
+        with_filenames=with_filenames,
+        suppress_tracebacks=suppress_tracebacks,
+        rescan=rescan,
+        use_mmap=use_mmap,
+        batch_size=batch_size,
+        begin_batches=begin_batches,
+        end_batches=end_batches,
+        cache_dir=cache_dir,
+        lazy_namespaces=lazy_namespaces,
+        profile=profile,
+        decompress=decompress,
+        decompress_thread=decompress_thread,
+    )
+    if output is not None:
+        sink = Sink.open(
+            output, flush_lines=flush_lines, flush_bytes=flush_bytes,
+        )
+        pipeline.emit = sink.write
+    else:
+        sink = None
+    pipeline.begin()
+    if follow:
+        def flush():
+            if sink is not None:
+                sink.flush()
+            sys.stdout.flush()
+        follow_sources(
+            pipeline, filenames, follow_interval, follow_from_start, flush,
+        )
+    elif jobs > 1:
+        run_parallel(
+            pipeline,
+            filenames,
+            jobs,
+            chunk_size=chunk_size,
+            ordered=not unordered,
+            merges=merges,
+            add_paths=add_paths,
+        )
+    else:
+        for filename in filenames:
+            pipeline.process_file(filename)
+    if sink is not None:
+        sink.flush()
+    pipeline.end()
+    if sink is not None:
+        sink.close()
+    if profile_stats is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_stats)
+    if profile:
+        pipeline.profiler.report()
     return 0
 
 
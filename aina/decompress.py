@@ -0,0 +1,171 @@
+"""Transparent decompression of the input of `aina stream`.
+
+Compressed inputs are recognized by their first bytes, whatever
+their name, and decompressed as they are read, one large chunk at a
+time, so rotated logs don't have to go through `zcat` first.
+gzip, bzip2 and xz are supported out of the box, zstd needs Python
+3.14 or the `zstandard` package.
+
+The decompressors release the GIL while they work, so
+`threaded_lines` can decompress in a background thread while the
+lines already decompressed are processed.
+"""
+import io
+import queue
+import threading
+
+# Compressed data is read this many bytes at a time
+READ_SIZE = 1 << 20
+
+def _gzip():
+    import zlib
+
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _bzip2():
+    import bz2
+
+    return bz2.BZ2Decompressor()
+
+def _xz():
+    import lzma
+
+    return lzma.LZMADecompressor()
+
+def _zstd():
+    try:
+        # Python 3.14+
+        from compression.zstd import ZstdDecompressor
+    except ImportError:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Reading zstd compressed input requires the zstandard package"
+            )
+        return zstandard.ZstdDecompressor().decompressobj()
+    return ZstdDecompressor()
+
+# name: (magic, decompressor factory)
+FORMATS = {
+    "gzip": (b"\x1f\x8b\x08", _gzip),
+    "bzip2": (b"BZh", _bzip2),
+    "xz": (b"\xfd7zXZ\x00", _xz),
+    "zstd": (b"\x28\xb5\x2f\xfd", _zstd),
+}
+
+def detect(data):
+    """Return the name of the compression format which `data`, the
+    first bytes of a file, is in or None if it isn't compressed."""
+    for name, (magic, factory) in FORMATS.items():
+        if data.startswith(magic):
+            # Leave out text which merely starts with "BZh"
+            if name == "bzip2" and data[3:4] not in b"123456789":
+                continue
+            return name
+    return None
+
+def peek(fin, size=6):
+    """Return up to the first `size` bytes of `fin` without consuming
+    them, or b"" if that isn't possible."""
+    if hasattr(fin, "peek"):
+        return fin.peek(size)[:size]
+    try:
+        if fin.seekable():
+            position = fin.tell()
+            data = fin.read(size)
+            fin.seek(position)
+            return data
+    except (AttributeError, OSError, ValueError):
+        pass
+    return b""
+
+class DecompressedReader(io.RawIOBase):
+    """Raw reader of the decompressed content of `fin`, compressed in
+    `format`. Concatenated streams, as written by `cat a.gz b.gz` or
+    parallel compressors, are read one after another."""
+
+    def __init__(self, fin, format, read_size=READ_SIZE):
+        self.fin = fin
+        self.factory = FORMATS[format][1]
+        self.read_size = read_size
+        self.decompressor = self.factory()
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if getattr(self.decompressor, "eof", False):
+                data = self.decompressor.unused_data
+                if not data:
+                    data = self.fin.read(self.read_size)
+                if not data:
+                    return 0
+                self.decompressor = self.factory()
+            else:
+                data = self.fin.read(self.read_size)
+                if not data:
+                    if not hasattr(self.decompressor, "eof"):
+                        # An older zstandard, which can't tell
+                        return 0
+                    raise EOFError(
+                        "Compressed input ended before the end-of-stream"
+                        " marker was reached"
+                    )
+            self.pending = memoryview(self.decompressor.decompress(data))
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+def open_decompressed(fin, format, read_size=READ_SIZE):
+    """Return a buffered binary file of the decompressed content of
+    `fin`, which yields its lines when iterated."""
+    reader = DecompressedReader(fin, format, read_size)
+    return io.BufferedReader(reader, read_size)
+
+def threaded_lines(fin, read_size=READ_SIZE, depth=4):
+    """Yield the lines of the binary file `fin`, read (and so
+    decompressed) by a background thread which stays up to `depth`
+    chunks of `read_size` bytes ahead."""
+    chunks = queue.Queue(depth)
+    done = threading.Event()
+
+    def put(item):
+        while not done.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read():
+        try:
+            partial = b""
+            for chunk in iter(lambda: fin.read(read_size), b""):
+                chunk = partial + chunk
+                end = chunk.rfind(b"\n") + 1
+                partial = chunk[end:]
+                if end:
+                    put(chunk[:end])
+            put(partial)
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=read, name="aina-decompress")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            for line in io.BytesIO(chunk):
+                yield line
+    finally:
+        done.set()
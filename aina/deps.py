@@ -0,0 +1,271 @@
+"""Track what each output of `aina doc` was rendered from.
+
+For every output, `Dependencies` records the content hash of each
+input it depended on: the template itself, the files which prepared
+the namespace (`--namespaces` and `--begins` scripts) and any file
+opened while the template was rendered. An output only needs to be
+rendered again when one of those hashes changes, so touching a file
+without changing it doesn't cause a rebuild.
+
+Files opened during rendering are seen through an audit hook
+(Python 3.8+), on older versions only the template and the
+namespace inputs are tracked.
+
+The records can be saved to and loaded from a JSON index so a later
+run only renders what changed since the last one.
+"""
+import os
+import sys
+import threading
+import contextlib
+
+_recorders = threading.local()
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+def _audit(event, args):
+    if event != "open" and event != "aina.include":
+        return
+    stack = getattr(_recorders, "stack", None)
+    if not stack:
+        return
+    if event == "aina.include":
+        stack[-1].add(args[0])
+        return
+    path, mode, flags = args
+    if isinstance(path, int) or path is None:
+        return
+    if mode is None:
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return
+    elif any(c in mode for c in "wax+"):
+        return
+    stack[-1].add(os.path.abspath(os.fsdecode(path)))
+
+def _install_hook():
+    global _hook_installed
+    if _hook_installed or not hasattr(sys, "addaudithook"):
+        return
+    with _hook_lock:
+        if not _hook_installed:
+            sys.addaudithook(_audit)
+            _hook_installed = True
+
+@contextlib.contextmanager
+def opened_files():
+    """Collect the paths of the files opened for reading by the
+    current thread into the yielded set."""
+    _install_hook()
+    try:
+        stack = _recorders.stack
+    except AttributeError:
+        stack = _recorders.stack = []
+    opened = set()
+    stack.append(opened)
+    try:
+        yield opened
+    finally:
+        stack.pop()
+
+def hash_file(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fingerprint(**options):
+    """Return a hash identifying `options`, which must be JSON
+    serializable."""
+    import json
+    import hashlib
+
+    data = json.dumps(options, sort_keys=True, default=list)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+# Bumped whenever the layout of the index changes
+INDEX_VERSION = 1
+
+class Dependencies(object):
+    """The inputs of each output and their content hashes.
+
+    `common` holds the inputs every output depends on, those which
+    prepared the namespace, and `fingerprint` identifies whatever else
+    went into the namespace and the rendering options. `results`
+    holds the content hash of each output as it was written."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.common = {}
+        self.fingerprint = None
+        self.outputs = {}
+        self.sources = {}
+        self.results = {}
+        self._digests = {}
+
+    def load(self, filename):
+        """Load the records saved by `save` to `filename`, a missing,
+        unreadable or outdated index is ignored."""
+        import json
+
+        try:
+            with open(filename, "r") as fin:
+                index = json.load(fin)
+        except (OSError, ValueError):
+            return False
+        if (not isinstance(index, dict)
+                or index.get("version") != INDEX_VERSION):
+            return False
+        self.clear()
+        self.common = index["common"]
+        self.fingerprint = index["fingerprint"]
+        for dst, output in index["outputs"].items():
+            self.outputs[dst] = output["inputs"]
+            self.sources[dst] = output["src"]
+            self.results[dst] = output["digest"]
+        for path, (mtime_ns, size, ino, digest) in index["digests"].items():
+            self._digests[path] = ((mtime_ns, size, ino), digest)
+        return True
+
+    def save(self, filename):
+        """Save the records to `filename`, replacing it atomically."""
+        import json
+
+        index = {
+            "version": INDEX_VERSION,
+            "fingerprint": self.fingerprint,
+            "common": self.common,
+            "outputs": dict(
+                (dst, {
+                    "src": self.sources[dst],
+                    "inputs": inputs,
+                    "digest": self.results.get(dst),
+                })
+                for dst, inputs in self.outputs.items()
+            ),
+            "digests": dict(
+                (path, list(key) + [digest])
+                for path, (key, digest) in self._digests.items()
+            ),
+        }
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp, "w") as fout:
+            json.dump(index, fout, separators=(",", ":"))
+        os.replace(tmp, filename)
+
+    def digest(self, path):
+        """Return the content hash of `path`, or None if it doesn't
+        exist. Hashes are only recomputed when the file's stat
+        changes."""
+        path = os.path.abspath(os.fspath(path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self._digests.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = hash_file(path)
+        self._digests[path] = (key, digest)
+        return digest
+
+    def _changed(self, inputs):
+        return any(
+            self.digest(path) != digest for path, digest in inputs.items()
+        )
+
+    def set_common(self, paths, fingerprint=None):
+        """Record `paths` as the inputs of the namespace, returning
+        True if they differ from the ones recorded before. If
+        `fingerprint` differs from the recorded one, every output
+        has to be rendered again."""
+        common = dict(
+            (path, self.digest(path)) for path in sorted(set(paths))
+        )
+        changed = common != self.common
+        self.common = common
+        if fingerprint != self.fingerprint:
+            self.outputs.clear()
+            self.sources.clear()
+            self.results.clear()
+            self.fingerprint = fingerprint
+            changed = True
+        return changed
+
+    def common_changed(self):
+        """Return True if any of the namespace inputs changed."""
+        return self._changed(self.common)
+
+    def changed(self, dst, src):
+        """Return True if `dst` has to be rendered from `src`."""
+        dst, src = os.path.abspath(str(dst)), os.path.abspath(str(src))
+        if self.sources.get(dst) != src or dst not in self.outputs:
+            return True
+        result = self.results.get(dst)
+        if result is None or result != self.digest(dst):
+            # The output was modified or removed since it was written
+            return True
+        inputs = self.outputs[dst]
+        if any(
+            inputs.get(path) != digest
+            for path, digest in self.common.items()
+        ):
+            return True
+        return self._changed(inputs)
+
+    @contextlib.contextmanager
+    def track(self, dst, src):
+        """Record `src`, the common inputs and every file opened within
+        the block as the inputs of `dst`. If the block raises, nothing
+        is recorded about `dst` so it is rendered again next time."""
+        dst, src = os.path.abspath(str(dst)), os.path.abspath(str(src))
+        with opened_files() as opened:
+            try:
+                yield opened
+            except BaseException:
+                self.outputs.pop(dst, None)
+                self.sources.pop(dst, None)
+                self.results.pop(dst, None)
+                raise
+            else:
+                opened.discard(dst)
+                opened.add(src)
+                inputs = dict(self.common)
+                for path in opened:
+                    if os.path.isfile(path):
+                        inputs[path] = self.digest(path)
+                self.outputs[dst] = inputs
+                self.sources[dst] = src
+                self.results[dst] = self.digest(dst)
+
+    def record(self, dst):
+        """Return what is recorded about `dst`, to be passed to
+        `add_record` of the `Dependencies` in another process."""
+        dst = os.path.abspath(str(dst))
+        return self.sources[dst], self.outputs[dst], self.results[dst]
+
+    def add_record(self, dst, record):
+        dst = os.path.abspath(str(dst))
+        self.sources[dst], self.outputs[dst], self.results[dst] = record
+
+    def affected(self, paths):
+        """Return the `(dst, src)` of the outputs depending on any of
+        `paths`."""
+        paths = set(os.path.abspath(str(path)) for path in paths)
+        return sorted(
+            (dst, self.sources[dst])
+            for dst, inputs in self.outputs.items()
+            if paths.intersection(inputs)
+        )
+
+    def inputs(self):
+        """Return every input of every output."""
+        paths = set(self.common)
+        for inputs in self.outputs.values():
+            paths.update(inputs)
+        return paths
@@ -0,0 +1,210 @@
+"""The engine behind `aina doc`.
+
+Templates are rendered from `src` to `dst`, one file at a time or
+spread over a pool of worker processes by `render_parallel`, and
+`dependencies` records what each output was rendered from so that
+only the outputs whose inputs changed are rendered again.
+"""
+import os
+import codecs
+import locale
+import logging
+import traceback
+from types import CodeType
+from pathlib import Path
+from aina.render import render, capture, Template
+from aina.output import write_atomic
+from aina.hooks import compile_hooks, exec_hooks
+from aina.namespace import make_namespace, LazyNamespace
+from aina.deps import Dependencies, opened_files, fingerprint
+
+def render_directory(
+    src, dst, recursive, namespace, rescan=False, pending=None,
+):
+    log = logging.getLogger(__name__)
+    src = Path(render(src, namespace))
+    dst = Path(render(dst, namespace))
+    for root, dirs, filenames in os.walk(str(src), topdown=True):
+        log.debug("In directory: {}".format(root))
+        for filename in filenames:
+            filename = Path(os.path.join(root, filename))
+            log.debug("Found file {}".format(filename))
+            _dst = os.path.join(
+                str(dst), os.path.relpath(str(filename), str(src)),
+            )
+            render_file(filename, _dst, namespace, rescan, pending)
+        if recursive:
+            for dirname in dirs:
+                new_dir = Path(dst / dirname)
+                log.debug("Recursive, rendering to {}".format(new_dir))
+                new_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            log.debug("Not recursive, exiting")
+            dirs.clear()
+
+dependencies = Dependencies()
+def render_file(src, dst, namespace, rescan=False, pending=None):
+    """Render `src` to `dst` if any of its inputs changed. If
+    `pending` is given, `(src, dst)` is appended to it instead so it
+    can be rendered later by `render_parallel`."""
+    log = logging.getLogger(__name__)
+    dst = Path(dst)
+    src = Path(src)
+    if dependencies.changed(dst, src):
+        if pending is not None:
+            pending.append((str(src), str(dst)))
+        else:
+            _render_file(src, dst, namespace, rescan)
+    else:
+        log.debug("File {} has not changed, skipping".format(src))
+        pass
+
+def _render_file(src, dst, namespace, rescan=False):
+    log = logging.getLogger(__name__)
+    log.warn("Rendering {} -> {}".format(src, dst))
+    with dependencies.track(dst, src):
+        # Not compile_template, which would keep the source of the
+        # last few hundred documents in memory
+        template = Template(src.read_text(), str(src))
+        chunks = _encode(
+            template.render_iter(namespace, rescan=rescan),
+            locale.getpreferredencoding(False),
+        )
+        if not write_atomic(dst, chunks, skip_unchanged=True):
+            log.debug("{} is unchanged, not writing".format(dst))
+
+def _encode(chunks, encoding):
+    encoder = codecs.getincrementalencoder(encoding)()
+    for chunk in chunks:
+        yield encoder.encode(chunk)
+    yield encoder.encode("", final=True)
+
+_namespace = None
+_rescan = False
+
+def _init_worker(options):
+    global _namespace, _rescan
+    # What --begins prints was already printed by the parent
+    with capture():
+        _namespace = prepare_namespace(**options)
+    _rescan = options["rescan"]
+
+def _render_task(task):
+    """Render one `(src, dst)` task in a worker process, returning
+    what was recorded about `dst` or the traceback of the error."""
+    src, dst = task
+    try:
+        _render_file(Path(src), Path(dst), _namespace, _rescan)
+    except Exception:
+        return src, dst, None, traceback.format_exc()
+    return src, dst, dependencies.record(dst), None
+
+def render_parallel(tasks, jobs, options):
+    """Render the `(src, dst)` pairs in `tasks` with `jobs` worker
+    processes and return the `(src, traceback)` of those which failed.
+
+    Rather than sending the namespace along with every task, each
+    worker prepares its own by passing `options`, a dict of keyword
+    arguments, to `prepare_namespace` once when it starts. Changes
+    made to the namespace by a template are only seen by the
+    templates rendered later by the same worker."""
+    from multiprocessing import Pool
+
+    errors = []
+    if not tasks:
+        return errors
+    chunksize = max(1, len(tasks) // (jobs * 4))
+    pool = Pool(jobs, initializer=_init_worker, initargs=(options,))
+    try:
+        results = pool.imap_unordered(_render_task, tasks, chunksize)
+        for src, dst, record, error in results:
+            if error is None:
+                dependencies.add_record(dst, record)
+            else:
+                errors.append((src, error))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return errors
+
+def prepare_namespace(
+    begins,
+    namespaces,
+    add_env,
+    rescan=False,
+    cache_dir=None,
+    lazy_namespaces=False,
+):
+    """Return a new namespace prepared by executing the hooks `begins`
+    and loading `namespaces`, recording everything which was read to
+    do so (apart from what is in `cache_dir`) as the common inputs of
+    every output."""
+    namespace = LazyNamespace() if lazy_namespaces else {}
+    options = fingerprint(
+        begins=list(begins),
+        namespaces=[os.path.abspath(path) for path in namespaces or []],
+        environ=dict(os.environ) if add_env else None,
+        rescan=rescan,
+    )
+    begins = compile_hooks(begins)
+    with opened_files() as opened:
+        exec_hooks(begins, namespace)
+        namespace.update(make_namespace(
+            namespace, namespaces, add_env, cache_dir, lazy_namespaces,
+        ))
+    if cache_dir is not None:
+        cache_dir = os.path.join(os.path.abspath(cache_dir), "")
+        opened = [path for path in opened if not path.startswith(cache_dir)]
+    scripts = [
+        hook.co_filename for hook in begins if isinstance(hook, CodeType)
+    ]
+    dependencies.set_common(
+        list(opened)
+        + list(namespaces or [])
+        + [path for path in scripts if os.path.isfile(path)],
+        options,
+    )
+    return namespace
+
+def render_src(src, dst, recursive, namespace, rescan=False, pending=None):
+    """Render `src`, a file or a directory, to `dst` and return the
+    path it was rendered to."""
+    log = logging.getLogger(__name__)
+    if src.is_dir():
+        log.debug("src is directory: {}".format(src))
+        if not dst.is_dir():
+            raise ValueError(
+                "If src is a directory, dst must also be a directory"
+            )
+        render_directory(src, dst, recursive, namespace, rescan, pending)
+    elif src.is_file():
+        log.debug("src is file: {}".format(src))
+        if dst.exists() and dst.is_dir():
+            dst = dst / src.name
+            log.debug("dst is directory, rendering to: {}".format(dst))
+        elif not dst.parent.exists():
+            log.debug("{} does not exist, creating...")
+            dst.parent.mkdir(parents=True, exist_ok=True)
+        render_file(src, dst, namespace, rescan, pending)
+    else:
+        raise ValueError("src must be either a file or directory.")
+    return dst
+
+def render_changed(path, src, dst, recursive, namespace, rescan=False):
+    """Re-render `path`, reported as changed by a watcher, where `src`
+    was rendered to `dst` by `render_src`."""
+    log = logging.getLogger(__name__)
+    if src.is_file():
+        if path == src:
+            render_file(src, dst, namespace, rescan)
+        return
+    _dst = dst / path.relative_to(src)
+    if path.is_dir():
+        log.debug("New directory {}, rendering to {}".format(path, _dst))
+        _dst.mkdir(parents=True, exist_ok=True)
+        render_directory(path, _dst, recursive, namespace, rescan)
+    elif path.is_file():
+        if not _dst.parent.exists():
+            _dst.parent.mkdir(parents=True, exist_ok=True)
+        render_file(path, _dst, namespace, rescan)
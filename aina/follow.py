@@ -0,0 +1,316 @@
+"""Follow many sources of lines at once for `aina stream --follow`.
+
+A `Follower` runs one asyncio task for each source and feeds the
+lines of all of them, as they arrive, through a single `Pipeline`.
+Each source keeps its own `filename` and `fnr` in the namespace.
+Sources are named on the command line:
+
+  * A file, which is polled for new lines every `interval` seconds
+    like `tail --follow=name`. When it is rotated (replaced by a new
+    file of the same name) or truncated, it is read again from the
+    start.
+  * A FIFO, which is opened again every time its writers close it.
+  * `-`, stdin.
+  * `unix:PATH` or `tcp:HOST:PORT`, a socket to listen on. Each
+    connection is a file of its own.
+
+When a file is rotated, a connection is closed or the follower is
+stopped, the `--end-files` hooks are executed for the source.
+"""
+import io
+import os
+import stat
+import click
+import signal
+import asyncio
+import logging
+
+# Bytes read at a time
+CHUNK_SIZE = 1 << 16
+
+def is_socket(spec):
+    return spec.startswith("unix:") or spec.startswith("tcp:")
+
+class Source(object):
+    """A source of lines, `name` is its value of `filename`. `fnr`
+    is None until its first line is seen."""
+
+    def __init__(self, name):
+        self.name = name
+        self.fnr = None
+        self.partial = b""
+
+class Follower(object):
+    """Feed the lines of the sources `specs` through `pipeline` until
+    `stop` is called or every source has ended. `flush` is called
+    whenever a chunk of lines has been processed. Files which already
+    exist are followed from their end unless `from_start` is True."""
+
+    def __init__(
+        self, pipeline, specs, interval=0.25, from_start=False, flush=None,
+    ):
+        self.pipeline = pipeline
+        self.specs = specs
+        self.interval = interval
+        self.from_start = from_start
+        self.flush = flush
+        self.log = logging.getLogger(__name__)
+        self.sources = set()
+        self.servers = []
+        self.connections = set()
+        self.loop = None
+        self.stopped = None
+
+    def feed(self, source, data):
+        """Process the complete lines in `data`, keeping whatever
+        follows the last newline until the rest of it arrives."""
+        data = source.partial + data
+        end = data.rfind(b"\n") + 1
+        source.partial = data[end:]
+        if end:
+            self.process(source, io.BytesIO(data[:end]))
+
+    def process(self, source, lines):
+        pipeline = self.pipeline
+        try:
+            if (pipeline.last_filename is not source
+                    and source.fnr is not None):
+                pipeline.resume(source, source.fnr, source.name)
+            try:
+                pipeline.process(source, lines, source.name)
+            finally:
+                source.fnr = pipeline.fnr
+                self.sources.add(source)
+            pipeline.flush_batch()
+        except:
+            if not pipeline.suppress_tracebacks:
+                self.log.exception("An unhandled exception occurred")
+        if self.flush is not None:
+            self.flush()
+
+    def end(self, source):
+        """Process the last line of `source`, even without a newline,
+        and end it."""
+        if source.partial:
+            partial, source.partial = source.partial, b""
+            self.process(source, [partial])
+        if source not in self.sources:
+            return
+        pipeline = self.pipeline
+        try:
+            if pipeline.last_filename is not source:
+                pipeline.resume(source, source.fnr, source.name)
+            pipeline.end_file()
+        except:
+            if not pipeline.suppress_tracebacks:
+                self.log.exception("An unhandled exception occurred")
+        finally:
+            self.sources.discard(source)
+            source.fnr = None
+            pipeline.last_filename = None
+        if self.flush is not None:
+            self.flush()
+
+    def follow(self, spec):
+        """Return the coroutine which follows `spec`."""
+        if spec == "-":
+            return self.follow_stdin()
+        if is_socket(spec):
+            return self.listen(spec)
+        try:
+            mode = os.stat(spec).st_mode
+        except OSError:
+            mode = 0
+        if stat.S_ISFIFO(mode):
+            return self.follow_fifo(spec)
+        return self.follow_file(spec)
+
+    async def follow_file(self, path):
+        source = Source(os.path.abspath(path))
+        fd = identity = None
+        seek_end = not self.from_start
+        try:
+            while True:
+                if fd is None:
+                    try:
+                        fd = os.open(path, os.O_RDONLY)
+                    except FileNotFoundError:
+                        pass
+                    else:
+                        status = os.fstat(fd)
+                        identity = (status.st_dev, status.st_ino)
+                        if seek_end:
+                            os.lseek(fd, 0, os.SEEK_END)
+                    # A file which shows up later is read from its start
+                    seek_end = False
+                if fd is not None:
+                    await self.drain(source, fd)
+                    try:
+                        status = os.stat(path)
+                    except FileNotFoundError:
+                        # Keep reading the old file until a new one shows up
+                        status = None
+                    if (status is not None
+                            and (status.st_dev, status.st_ino) != identity):
+                        self.log.debug("{} was rotated".format(path))
+                        await self.drain(source, fd)
+                        self.end(source)
+                        os.close(fd)
+                        fd = None
+                        continue
+                    position = os.lseek(fd, 0, os.SEEK_CUR)
+                    if status is not None and status.st_size < position:
+                        self.log.debug("{} was truncated".format(path))
+                        self.end(source)
+                        os.lseek(fd, 0, os.SEEK_SET)
+                        continue
+                await asyncio.sleep(self.interval)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def drain(self, source, fd):
+        """Feed everything which can be read from `fd` right now,
+        letting the other sources in between chunks."""
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                return
+            self.feed(source, data)
+            await asyncio.sleep(0)
+
+    async def read_pipe(self, source, pipe):
+        """Feed what is read from the pipe `pipe` until it is closed."""
+        reader = asyncio.StreamReader()
+        transport, _ = await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe,
+        )
+        try:
+            await self.read(source, reader)
+        finally:
+            transport.close()
+
+    async def read(self, source, reader):
+        """Feed what is read from the `StreamReader` `reader`."""
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.feed(source, data)
+        self.end(source)
+
+    async def follow_fifo(self, path):
+        name = os.path.abspath(path)
+        while True:
+            # Opening a FIFO without O_NONBLOCK would wait for a writer
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            pipe = os.fdopen(fd, "rb", buffering=0)
+            await self.read_pipe(Source(name), pipe)
+            # Every writer closed it, wait for the next one
+            await asyncio.sleep(self.interval)
+
+    async def follow_stdin(self):
+        source = Source("-")
+        stream = click.get_binary_stream("stdin")
+        try:
+            mode = os.fstat(stream.fileno()).st_mode
+        except (AttributeError, ValueError, io.UnsupportedOperation):
+            mode = None
+        if mode is None or stat.S_ISREG(mode):
+            # Nothing to wait for, as when stdin is redirected from a file
+            for data in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                self.feed(source, data)
+                await asyncio.sleep(0)
+            self.end(source)
+        else:
+            pipe = os.fdopen(os.dup(stream.fileno()), "rb", buffering=0)
+            await self.read_pipe(source, pipe)
+
+    async def listen(self, spec):
+        kind, _, address = spec.partition(":")
+
+        async def connected(reader, writer):
+            closed = self.loop.create_future()
+            connection = (reader, closed)
+            self.connections.add(connection)
+            try:
+                await self.read(Source(spec), reader)
+            finally:
+                writer.close()
+                self.connections.discard(connection)
+                closed.set_result(None)
+
+        if kind == "unix":
+            server = await asyncio.start_unix_server(connected, address)
+        else:
+            host, _, port = address.rpartition(":")
+            server = await asyncio.start_server(
+                connected, host.strip("[]") or None, int(port),
+            )
+        self.log.debug("Listening on {}".format(spec))
+        self.servers.append((spec, server))
+
+    async def run(self):
+        self.loop = asyncio.get_event_loop()
+        self.stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stopped.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not on Windows nor outside of the main thread
+                pass
+        tasks = set(
+            asyncio.ensure_future(self.follow(spec)) for spec in self.specs
+        )
+        stopped = asyncio.ensure_future(self.stopped.wait())
+        try:
+            while tasks and not stopped.done():
+                done, tasks = await asyncio.wait(
+                    tasks | {stopped}, return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done - {stopped}:
+                    if not task.cancelled() and task.exception() is not None:
+                        self.log.error("{}".format(task.exception()))
+                tasks.discard(stopped)
+                if not tasks and self.servers:
+                    # Connections are handled by the servers from now on
+                    await stopped
+        finally:
+            for task in tasks | {stopped}:
+                task.cancel()
+            await asyncio.gather(*(tasks | {stopped}), return_exceptions=True)
+            for spec, server in self.servers:
+                server.close()
+                if spec.startswith("unix:"):
+                    try:
+                        os.unlink(spec[len("unix:"):])
+                    except OSError:
+                        pass
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self.loop.remove_signal_handler(signum)
+                except (NotImplementedError, RuntimeError, ValueError):
+                    pass
+            # What the open connections already sent is processed
+            for reader, closed in list(self.connections):
+                reader.feed_eof()
+            await asyncio.gather(
+                *(closed for reader, closed in list(self.connections))
+            )
+            by_name = sorted(self.sources, key=lambda source: source.name)
+            for source in by_name:
+                self.end(source)
+
+    def stop(self):
+        """Stop following, from any thread."""
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+def follow(pipeline, specs, interval=0.25, from_start=False, flush=None):
+    """Follow `specs` with a `Follower` until they all end or the
+    process is interrupted."""
+    loop = asyncio.new_event_loop()
+    try:
+        follower = Follower(pipeline, specs, interval, from_start, flush)
+        loop.run_until_complete(follower.run())
+    finally:
+        loop.close()
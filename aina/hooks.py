@@ -0,0 +1,181 @@
+"""Hooks and tests, the snippets of Python source code (or names of
+files containing it) passed on the command line.
+
+Both are compiled once, before any input is processed, so that
+running them is only a matter of executing a code object.
+"""
+import os
+import re
+import ast
+import logging
+from types import CodeType
+from aina.render import render, TRACE
+
+def compile_hooks(exprs):
+    """Resolve each of `exprs` to a code object once, up front.
+
+    Hooks which are templates themselves (contain `{{` or `{%`) can
+    only be resolved once they are rendered, so they are returned
+    as-is and handled by `exec_hooks` each time they are run."""
+    log = logging.getLogger(__name__)
+    hooks = []
+    for expr in exprs:
+        if "{{" in expr or "{%" in expr:
+            log.debug("{} is a template, resolving at runtime".format(expr))
+            hooks.append(expr)
+        elif os.path.isfile(expr):
+            log.debug("{} is a file, compiling...".format(expr))
+            with open(expr, "r") as fin:
+                hooks.append(compile(fin.read(), expr, "exec"))
+        else:
+            log.debug("Compiling {}".format(expr))
+            hooks.append(compile(expr, "<hook>", "exec"))
+    return hooks
+
+def exec_hooks(exprs, namespace):
+    for expr in exprs:
+        if isinstance(expr, CodeType):
+            if expr.co_filename != "<hook>":
+                namespace["__file__"] = expr.co_filename
+            exec(expr, namespace)
+            continue
+        if callable(expr):
+            # A hook wrapped by `aina.profiling`
+            expr(namespace)
+            continue
+        _expr = render(expr, namespace)
+        # Looked up here, hooks which are code objects are run for
+        # every line and never log anything
+        log = logging.getLogger(__name__)
+        trace = log.isEnabledFor(TRACE)
+        if os.path.isfile(_expr):
+            if trace:
+                log.log(TRACE, "{} is a file, executing...".format(_expr))
+            with open(_expr, "r") as fin:
+                code = compile(fin.read(), _expr, "exec")
+            namespace["__file__"] = _expr
+            exec(code, namespace)
+        else:
+            if trace:
+                log.log(TRACE, "Executing {}".format(_expr))
+            exec(_expr, namespace)
+
+def _string_literal(node):
+    """Return the value of `node` if it is a string literal, else None."""
+    value = getattr(node, "value", getattr(node, "s", None))
+    return value if isinstance(value, str) else None
+
+def _is_line(node):
+    return isinstance(node, ast.Name) and node.id == "line"
+
+def _fast_test(test, namespace):
+    """Return a function which evaluates `test` against the raw
+    bytes of a line, or None if `test` is not one of the common
+    shapes below, which don't need the namespace to be evaluated:
+
+      * 'needle' in line
+      * 'needle' not in line
+      * 'needle' in line.lower()
+      * re.search('pattern', line)
+      * re.match('pattern', line)
+
+    The raw line may be any bytes-like object, including a
+    `memoryview` of a memory-mapped file."""
+    try:
+        node = ast.parse(test.strip(), mode="eval").body
+    except SyntaxError:
+        return None
+    if (isinstance(node, ast.Compare)
+            and len(node.ops) == 1
+            and isinstance(node.ops[0], (ast.In, ast.NotIn))
+            and _string_literal(node.left) is not None):
+        needle = _string_literal(node.left)
+        negate = isinstance(node.ops[0], ast.NotIn)
+        haystack = node.comparators[0]
+        if _is_line(haystack):
+            search = re.compile(re.escape(needle.encode())).search
+            if negate:
+                return lambda line: search(line) is None
+            return lambda line: search(line) is not None
+        if (not negate
+                and isinstance(haystack, ast.Call)
+                and not haystack.args
+                and not haystack.keywords
+                and isinstance(haystack.func, ast.Attribute)
+                and haystack.func.attr == "lower"
+                and _is_line(haystack.func.value)
+                and needle.isascii()
+                and needle == needle.lower()):
+            # Matching bytes case-insensitively only knows about
+            # ASCII, so the first non-ASCII byte sends the line
+            # through str.lower() instead.
+            search = re.compile(
+                re.escape(needle.encode()) + b"|[\x80-\xff]", re.IGNORECASE,
+            ).search
+            def check(line):
+                match = search(line)
+                if match is None:
+                    return False
+                if line[match.start()] < 0x80:
+                    return True
+                return needle in bytes(line).decode().lower()
+            return check
+    if (isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr in ("search", "match")
+            and isinstance(node.func.value, ast.Name)
+            and namespace.get(node.func.value.id) is re
+            and len(node.args) == 2
+            and not node.keywords
+            and _string_literal(node.args[0]) is not None
+            and _is_line(node.args[1])):
+        regex = re.compile(_string_literal(node.args[0]))
+        pattern = getattr(regex, node.func.attr)
+        return lambda line: pattern(bytes(line).decode()) is not None
+    return None
+
+def compile_tests(tests, namespace):
+    """Compile `tests` once into a `(prefilter, predicate)` pair.
+
+    `prefilter` accepts the raw bytes of a line and handles the tests
+    which `_fast_test` recognizes, it can reject a line before the
+    namespace is updated. `predicate` accepts the namespace and
+    evaluates the remaining tests combined into a single
+    short-circuiting expression, as if joined with `and`. Either is
+    None when there is nothing for it to do."""
+    log = logging.getLogger(__name__)
+    checks, sources, dynamic = [], [], []
+    for test in tests:
+        if "{{" in test or "{%" in test:
+            dynamic.append(test)
+            continue
+        check = _fast_test(test, namespace)
+        if check is not None:
+            log.debug("Using fast path for test {}".format(test))
+            checks.append(check)
+        else:
+            sources.append(ast.parse(test.strip(), "<tests>", "eval").body)
+
+    prefilter = None
+    if len(checks) == 1:
+        prefilter = checks[0]
+    elif checks:
+        prefilter = lambda line: all(check(line) for check in checks)
+
+    predicate = None
+    if sources or dynamic:
+        # Combined once parsed rather than as text, which a trailing
+        # comment in a test would break
+        if len(sources) > 1:
+            body = ast.BoolOp(op=ast.And(), values=sources)
+        elif sources:
+            body = sources[0]
+        else:
+            body = ast.parse("True", "<tests>", "eval").body
+        tree = ast.fix_missing_locations(ast.Expression(body=body))
+        code = compile(tree, "<tests>", "eval")
+        def predicate(namespace):
+            return eval(code, namespace) and all(
+                eval(render(test, namespace), namespace) for test in dynamic
+            )
+    return prefilter, predicate
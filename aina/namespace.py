@@ -0,0 +1,336 @@
+"""Namespaces in which templates and hooks are evaluated.
+
+The namespace classes are `dict` subclasses so they can be passed
+directly as the globals to `exec` and `eval`, names which aren't
+present are looked up through `__missing__` which allows values to
+be computed only when a template or hook actually uses them.
+
+Namespace files are loaded by `load_namespace`, which picks a parser
+by file extension and can cache the parsed data on disk. For large
+files, `index_namespace` keeps an index of the data on disk instead
+so that a `LazyNamespace` only loads the values which are used.
+"""
+import os
+import gc
+import sys
+import logging
+import contextlib
+from builtins import __dict__ as _builtins
+
+# The modules needed to load namespace files are only imported when
+# there are some, most runs of `aina stream` don't have any.
+
+def make_namespace(
+    namespace, namespaces, add_env, cache_dir=None, lazy=False,
+):
+    """Add the environment, if `add_env`, and the contents of the
+    files `namespaces` to `namespace`.
+
+    If `lazy` is True, `namespace` must be a `LazyNamespace`. The
+    environment and, with a `cache_dir` to keep their indexes in, the
+    JSON and literal namespace files are then added as sources of the
+    namespace rather than copied into it."""
+    if add_env:
+        if lazy:
+            _add_source(namespace, os.environ)
+        else:
+            namespace.update(os.environ)
+    if namespaces is not None:
+        for _namespace in namespaces:
+            if lazy and cache_dir is not None:
+                source = index_namespace(_namespace, namespace, cache_dir)
+                if isinstance(source, NamespaceIndex):
+                    _add_source(namespace, source)
+                    continue
+            else:
+                source = load_namespace(_namespace, namespace, cache_dir)
+            namespace.update(source)
+    return namespace
+
+def _add_source(namespace, source):
+    # Values already set would hide those of the new source, which
+    # must take precedence as they would if it was copied in
+    for key in [key for key in namespace if key in source]:
+        del namespace[key]
+    namespace.sources.append(source)
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Parsing a large file allocates many objects which can't be
+    garbage, so collecting while doing so is wasted time."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def _parse(text, filename, namespace):
+    """Return the value of the Python expression `text` and whether
+    it is made of literals only, in which case it is evaluated
+    without executing any code."""
+    import ast
+
+    tree = ast.parse(text, filename, mode="eval")
+    try:
+        return ast.literal_eval(tree), True
+    except ValueError:
+        return eval(compile(tree, filename, "eval"), namespace), False
+
+def _load(filename, data, namespace):
+    """Return the value of the namespace file `filename` which holds
+    `data`, and whether it is pure data."""
+    import json
+    import locale
+
+    with _gc_paused():
+        if filename.endswith(".json"):
+            return json.loads(data), True
+        text = data.decode(locale.getpreferredencoding(False))
+        if filename.endswith(".py"):
+            return eval(compile(text, filename, "eval"), namespace), False
+        return _parse(text, filename, namespace)
+
+def _cache_path(cache_dir, data, extension):
+    import hashlib
+
+    return os.path.join(
+        cache_dir,
+        "namespaces",
+        "{}.{}.{}".format(
+            hashlib.sha256(data).hexdigest(),
+            sys.implementation.cache_tag,
+            extension,
+        ),
+    )
+
+def load_namespace(filename, namespace=None, cache_dir=None):
+    """Return the contents of the namespace file `filename`.
+
+    Files ending in `.json` are parsed as JSON and `.py` files are
+    evaluated as a Python expression within `namespace`. Anything
+    else is expected to be a Python literal (a dict display) which is
+    parsed without executing any code, but is evaluated like a `.py`
+    file if it turns out not to be one.
+
+    If `cache_dir` is given, the data parsed from JSON and literal
+    files is pickled there, keyed by the hash of the file's content,
+    and loaded from there as long as the file doesn't change."""
+    import pickle
+    from aina.output import write_atomic
+
+    log = logging.getLogger(__name__)
+    if namespace is None:
+        namespace = {}
+    with open(filename, "rb") as fin:
+        data = fin.read()
+    cached = None
+    if cache_dir is not None and not filename.endswith(".py"):
+        cached = _cache_path(cache_dir, data, "pickle")
+        try:
+            with open(cached, "rb") as fin:
+                value = pickle.load(fin)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        else:
+            log.debug("Loaded {} from {}".format(filename, cached))
+            return value
+    value, literal = _load(filename, data, namespace)
+    if cached is not None and literal:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        write_atomic(cached, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    return value
+
+def index_namespace(filename, namespace, cache_dir):
+    """Return a `NamespaceIndex` of the namespace file `filename`
+    kept in `cache_dir`, building it if the file changed since it was
+    last indexed. Files which can't be indexed, because they aren't
+    pure data or hold more than a dict with string keys, are loaded
+    as by `load_namespace` and their contents returned instead."""
+    log = logging.getLogger(__name__)
+    with open(filename, "rb") as fin:
+        data = fin.read()
+    cached = None
+    if not filename.endswith(".py"):
+        cached = _cache_path(cache_dir, data, "sqlite")
+        if os.path.isfile(cached):
+            log.debug("Using index {} of {}".format(cached, filename))
+            return NamespaceIndex(cached)
+    value, literal = _load(filename, data, namespace)
+    if (cached is not None
+            and literal
+            and isinstance(value, dict)
+            and all(isinstance(key, str) for key in value)):
+        log.debug("Indexing {} to {}".format(filename, cached))
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        return NamespaceIndex.build(cached, value)
+    return value
+
+class NamespaceIndex(object):
+    """Read-only mapping backed by a sqlite database, built from the
+    contents of a namespace file by `build`. Only the keys are read
+    when it is opened, each value is unpickled when it is looked up."""
+
+    def __init__(self, filename):
+        import sqlite3
+        import pickle
+        from urllib.parse import quote
+
+        self._loads = pickle.loads
+        self.filename = filename
+        self.connection = sqlite3.connect(
+            "file:{}?mode=ro".format(quote(os.path.abspath(filename))),
+            uri=True,
+            check_same_thread=False,
+        )
+        self.keys = frozenset(
+            key for key, in self.connection.execute(
+                "SELECT key FROM namespace"
+            )
+        )
+
+    @classmethod
+    def build(cls, filename, data):
+        """Store the dict `data` in a new database `filename` and
+        return a `NamespaceIndex` of it."""
+        import sqlite3
+        import pickle
+
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        connection = sqlite3.connect(tmp)
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE namespace"
+                    " (key TEXT PRIMARY KEY, value BLOB)"
+                )
+                connection.executemany(
+                    "INSERT INTO namespace VALUES (?, ?)",
+                    (
+                        (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                        for key, value in data.items()
+                    ),
+                )
+        finally:
+            connection.close()
+        os.replace(tmp, filename)
+        return cls(filename)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        value, = self.connection.execute(
+            "SELECT value FROM namespace WHERE key = ?", (key,)
+        ).fetchone()
+        return self._loads(value)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+class LazyNamespace(dict):
+    """Namespace where names which aren't set are looked up in
+    `sources`, a list of mappings searched from the last one to the
+    first, and kept once found. A copy of a `LazyNamespace` shares
+    its sources."""
+
+    def __init__(self, *args, **kwargs):
+        super(LazyNamespace, self).__init__(*args, **kwargs)
+        if args and isinstance(args[0], LazyNamespace):
+            self.sources = list(args[0].sources)
+        else:
+            self.sources = []
+
+    def __missing__(self, key):
+        for source in reversed(self.sources):
+            if key in source:
+                value = self[key] = source[key]
+                return value
+        # Python only falls back to the builtins once the KeyError is
+        # raised, which is slow. They aren't kept in the namespace so
+        # they don't show up when iterating over it.
+        if key in _builtins:
+            return _builtins[key]
+        raise KeyError(key)
+
+class LineNamespace(LazyNamespace):
+    """Namespace for `aina stream` where the per-line values `line`,
+    `fields` and `nf` are computed from the raw bytes of the current
+    line the first time they are used, and then cached until the
+    next line is set. The raw line may be any bytes-like object, it
+    is only copied into `bytes` when one of those values is needed."""
+
+    LAZY = ("line", "fields", "nf")
+    BATCH = ("lines", "batch_fields")
+
+    def __init__(self, *args, **kwargs):
+        super(LineNamespace, self).__init__(*args, **kwargs)
+        self.raw = b""
+        self.batch = []
+        self.field_sep = None
+
+    def set_field_sep(self, field_sep):
+        if isinstance(field_sep, str):
+            field_sep = field_sep.encode()
+        self.field_sep = field_sep
+
+    def set_line(self, raw, nr, fnr):
+        self.raw = raw
+        for key in self.LAZY:
+            self.pop(key, None)
+        self["nr"] = nr
+        self["fnr"] = fnr
+
+    def set_batch(self, raws):
+        """Set the raw lines of the current batch, `lines` and
+        `batch_fields` are computed from them when first used."""
+        self.batch = raws
+        for key in self.BATCH:
+            self.pop(key, None)
+        self["nb"] = len(raws)
+
+    def column(self, index, type=float):
+        """Return field `index` of every line in the current batch
+        converted to `type`, as a NumPy array if NumPy is installed or
+        as a list otherwise."""
+        values = [fields[index] for fields in self["batch_fields"]]
+        try:
+            import numpy
+        except ImportError:
+            return [type(value) for value in values]
+        return numpy.array(values).astype(type)
+
+    def detach(self):
+        """Copy the current line out of whatever buffer it refers to,
+        so that buffer can be released."""
+        if type(self.raw) is not bytes:
+            self.raw = bytes(self.raw)
+
+    def __missing__(self, key):
+        # None of the names below is a builtin
+        if key in _builtins and not self.sources:
+            return _builtins[key]
+        if key == "line":
+            self.detach()
+            value = self.raw.decode()
+        elif key == "fields":
+            self.detach()
+            value = self.raw.split(self.field_sep)
+        elif key == "nf":
+            value = len(self["fields"])
+        elif key == "lines":
+            value = [raw.decode() for raw in self.batch]
+        elif key == "batch_fields":
+            value = [raw.split(self.field_sep) for raw in self.batch]
+        elif key == "column":
+            return self.column
+        else:
+            return super(LineNamespace, self).__missing__(key)
+        self[key] = value
+        return value
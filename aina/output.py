@@ -0,0 +1,155 @@
+"""Output sinks for rendered results.
+
+By default `aina stream` sends every rendered template through the
+logging system, which is flexible but costs a LogRecord, formatting
+and a handler lock per line. A `Sink` writes the results directly
+to a binary stream instead, batching them in memory and flushing
+according to a configurable policy.
+
+`aina doc` writes its outputs with `write_atomic`.
+"""
+import os
+import sys
+import click
+
+# Flush once this many bytes are waiting, unless told otherwise
+DEFAULT_FLUSH_BYTES = 1 << 16
+
+class Sink(object):
+    """Buffered writer of rendered results to the binary `stream`.
+
+    Results are flushed to `stream` after every `flush_lines` results
+    or once `flush_bytes` bytes are waiting, whichever comes first. A
+    value of 0 disables that trigger, with both disabled results are
+    only written by `flush` or `close`."""
+
+    def __init__(
+        self,
+        stream,
+        flush_lines=0,
+        flush_bytes=DEFAULT_FLUSH_BYTES,
+        encoding="utf-8",
+        owned=False,
+    ):
+        self.stream = stream
+        self.flush_lines = flush_lines
+        self.flush_bytes = flush_bytes
+        self.encoding = encoding
+        self.owned = owned
+        self._pending = []
+        self._lines = 0
+        self._bytes = 0
+
+    @classmethod
+    def open(cls, filename, **kwargs):
+        """Return a `Sink` writing to `filename`, "-" means stdout."""
+        if filename == "-":
+            return cls(click.get_binary_stream("stdout"), **kwargs)
+        return cls(open(filename, "wb"), owned=True, **kwargs)
+
+    def write(self, result):
+        data = result.encode(self.encoding) + b"\n"
+        self._pending.append(data)
+        self._lines += 1
+        self._bytes += len(data)
+        if ((self.flush_lines and self._lines >= self.flush_lines)
+                or (self.flush_bytes and self._bytes >= self.flush_bytes)):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            # Anything printed by hooks comes first
+            sys.stdout.flush()
+            self.stream.write(b"".join(self._pending))
+            self._pending = []
+            self._lines = self._bytes = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.stream.close()
+
+def _temporary(path):
+    """Return a binary file open for writing next to `path`, and its
+    name."""
+    import tempfile
+
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(
+        prefix=".{}.".format(name), suffix=".tmp", dir=directory or ".",
+    )
+    return os.fdopen(fd, "wb"), tmp
+
+def _copy(fin, fout, size):
+    """Copy the first `size` bytes of `fin` to `fout`."""
+    fin.seek(0)
+    while size > 0:
+        block = fin.read(min(size, 1 << 20))
+        if not block:
+            break
+        fout.write(block)
+        size -= len(block)
+
+def write_atomic(path, data, skip_unchanged=False):
+    """Replace the contents of the file `path` with `data`, either
+    bytes or an iterable of bytes chunks, and return True.
+
+    `data` is written to a temporary file next to `path` which is then
+    renamed over it, so `path` never holds a partial write. An existing
+    file keeps its permissions, a new one gets the default ones.
+
+    If `skip_unchanged` is True, `data` is compared with the current
+    contents of `path` as it comes and the temporary file is only
+    created at the first difference, starting with a copy of what
+    matched. If there is no difference, nothing at all is written,
+    `path` is left alone and False is returned."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = [data]
+    path = os.fspath(path)
+    current = None
+    if skip_unchanged:
+        try:
+            current = open(path, "rb")
+        except OSError:
+            pass
+    fout = tmp = None
+    try:
+        matched = 0
+        for chunk in data:
+            if fout is None:
+                if current is not None and current.read(len(chunk)) == chunk:
+                    matched += len(chunk)
+                    continue
+                fout, tmp = _temporary(path)
+                if matched:
+                    _copy(current, fout, matched)
+            fout.write(chunk)
+        if fout is None:
+            if current is not None and not current.read(1):
+                return False
+            # `path` has more to it than `data`
+            fout, tmp = _temporary(path)
+            if matched:
+                _copy(current, fout, matched)
+        fout.close()
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode & 0o7777)
+        os.replace(tmp, path)
+    except BaseException:
+        if fout is not None:
+            fout.close()
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        raise
+    finally:
+        if current is not None:
+            current.close()
+    return True
@@ -0,0 +1,198 @@
+"""Timing of the stages of an `aina stream` pipeline.
+
+With `--profile`, a `Profiler` wraps each hook, test and template of
+the `Pipeline` so the time spent in it and the number of times it
+ran are recorded, along with the time spent reading lines, decoding
+them and writing the results. Without it nothing is wrapped, so the
+pipeline runs exactly as it otherwise would.
+
+Times are inclusive: a template which uses `line` counts the time
+taken to decode it, which is also counted under `decode`.
+"""
+import sys
+from time import perf_counter
+from aina.hooks import exec_hooks, compile_tests
+from aina.namespace import LineNamespace
+
+# The hooks of a `Pipeline`, by attribute
+HOOKS = (
+    "begins",
+    "begin_files",
+    "begin_lines",
+    "end_lines",
+    "end_files",
+    "ends",
+    "begin_batches",
+    "end_batches",
+)
+
+def _label(source, width=40):
+    """Return the first line of `source`, shortened to `width`."""
+    source = source.strip().splitlines()[0] if source.strip() else ""
+    if len(source) > width:
+        source = source[:width - 3] + "..."
+    return source
+
+class ProfiledTemplate(object):
+    """A compiled template whose `render` is timed."""
+
+    def __init__(self, template, render):
+        self.source = template.source
+        self.render = render
+
+class ProfiledLineNamespace(LineNamespace):
+    """A `LineNamespace` which times the decoding and splitting of
+    the current line (or batch) as `decode`."""
+
+    profiler = None
+
+    def __missing__(self, key):
+        if key not in self.LAZY and key not in self.BATCH:
+            return super(ProfiledLineNamespace, self).__missing__(key)
+        start = perf_counter()
+        try:
+            return super(ProfiledLineNamespace, self).__missing__(key)
+        finally:
+            self.profiler.add(("decode", key), perf_counter() - start)
+
+class Profiler(object):
+    """The number of calls and cumulative time of each stage, keyed
+    by `(where, name)`."""
+
+    def __init__(self):
+        self.stats = {}
+        self.started = perf_counter()
+
+    def stat(self, key):
+        return self.stats.setdefault(key, [0, 0.0])
+
+    def add(self, key, elapsed, calls=1):
+        stat = self.stat(key)
+        stat[0] += calls
+        stat[1] += elapsed
+
+    def take(self):
+        """Return a copy of the stats and start counting from zero,
+        the wrapped callables keep recording into the same stats."""
+        taken = {}
+        for key, stat in self.stats.items():
+            if stat[0]:
+                taken[key] = tuple(stat)
+                stat[:] = [0, 0.0]
+        return taken
+
+    def merge(self, stats):
+        """Add `stats`, as returned by `take` in another process."""
+        for key, (calls, elapsed) in stats.items():
+            self.add(key, elapsed, calls)
+
+    def timed(self, where, name, func):
+        """Return `func` wrapped to record its calls under `(where, name)`."""
+        stat = self.stat((where, name))
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stat[0] += 1
+                stat[1] += perf_counter() - start
+        timed.__wrapped__ = func
+        return timed
+
+    def iterate(self, where, name, iterable):
+        """Yield the items of `iterable`, recording the time spent
+        waiting for each of them."""
+        stat = self.stat((where, name))
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stat[1] += perf_counter() - start
+                return
+            stat[0] += 1
+            stat[1] += perf_counter() - start
+            yield item
+
+    def hooks(self, where, sources, hooks):
+        """Return `hooks`, compiled from `sources`, as callables which
+        `exec_hooks` runs and times one by one."""
+        def run(hook):
+            return lambda namespace: exec_hooks([hook], namespace)
+
+        return [
+            self.timed(where, _label(source), run(hook))
+            for source, hook in zip(sources, hooks)
+        ]
+
+    def tests(self, tests, namespace):
+        """Compile `tests` like `compile_tests`, but one at a time so
+        each of them is timed on its own."""
+        checks, predicates = [], []
+        for test in tests:
+            prefilter, predicate = compile_tests([test], namespace)
+            label = _label(test)
+            if prefilter is not None:
+                checks.append(self.timed("--tests", label, prefilter))
+            if predicate is not None:
+                predicates.append(self.timed("--tests", label, predicate))
+        prefilter = predicate = None
+        if checks:
+            prefilter = lambda line: all(check(line) for check in checks)
+        if predicates:
+            predicate = lambda namespace: all(
+                check(namespace) for check in predicates
+            )
+        return prefilter, predicate
+
+    def instrument(self, pipeline):
+        """Wrap the hooks and templates of `pipeline`."""
+        for attribute in HOOKS:
+            setattr(pipeline, attribute, self.hooks(
+                "--" + attribute.replace("_", "-"),
+                pipeline.options[attribute],
+                getattr(pipeline, attribute),
+            ))
+        pipeline.templates = [
+            ProfiledTemplate(template, self.timed(
+                "--templates", _label(template.source), template.render,
+            ))
+            for template in pipeline.templates
+        ]
+
+    def namespace(self, base):
+        namespace = ProfiledLineNamespace(base)
+        namespace.profiler = self
+        return namespace
+
+    def report(self, file=None):
+        """Write a table of the stats, slowest first, to `file`
+        (stderr by default)."""
+        file = sys.stderr if file is None else file
+        total = perf_counter() - self.started
+        rows = sorted(
+            (
+                (where, name, calls, elapsed)
+                for (where, name), (calls, elapsed) in self.stats.items()
+                if calls
+            ),
+            key=lambda row: row[3],
+            reverse=True,
+        )
+        line = "{:<16} {:<40} {:>10} {:>10} {:>12} {:>7}"
+        header = ("where", "name", "calls", "total s", "per call us", "%")
+        print(line.format(*header), file=file)
+        row = "{:<16} {:<40} {:>10} {:>10.3f} {:>12.1f} {:>6.1f}%"
+        for where, name, calls, elapsed in rows:
+            print(row.format(
+                where,
+                name,
+                calls,
+                elapsed,
+                elapsed / calls * 1e6,
+                elapsed / total * 100 if total else 0,
+            ), file=file)
+        print("{:<16} {:<40} {:>10} {:>10.3f}".format(
+            "total", "", "", total,
+        ), file=file)
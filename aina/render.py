@@ -1,45 +1,273 @@
 from textwrap import dedent
-from hashlib import sha256
+from functools import lru_cache
 import logging
-import click
 import sys
+import os
 import re
-from io import StringIO
+import threading
 import contextlib
 
+_captures = threading.local()
+_install_lock = threading.Lock()
+
+class _StdoutProxy(object):
+    """Stand-in for `sys.stdout` which sends writes to the innermost
+    capture of the current thread, or to the real stream when the
+    thread isn't capturing anything."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        stack = getattr(_captures, "stack", None)
+        if stack:
+            stack[-1].append(text)
+            return len(text)
+        return self._stream.write(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
 @contextlib.contextmanager
-def stdoutIO(stdout=None):
-    old = sys.stdout
-    if stdout is None:
-        stdout = StringIO()
-    sys.stdout = stdout
-    yield stdout
-    sys.stdout = old
+def capture():
+    """Capture everything the current thread writes to `sys.stdout`
+    into the yielded list of strings.
+
+    `sys.stdout` is only replaced once, by a proxy which is left in
+    place, so other threads keep writing to the real stream and may
+    capture their own output at the same time."""
+    if not isinstance(sys.stdout, _StdoutProxy):
+        with _install_lock:
+            if not isinstance(sys.stdout, _StdoutProxy):
+                sys.stdout = _StdoutProxy(sys.stdout)
+    try:
+        stack = _captures.stack
+    except AttributeError:
+        stack = _captures.stack = []
+    output = []
+    stack.append(output)
+    try:
+        yield output
+    finally:
+        stack.pop()
 
 expressions = re.compile(r"(\{\{(.*?)\}\})", re.DOTALL)
 statements = re.compile(r"(\{%(.*?)%\})", re.DOTALL)
+includes = re.compile(r"\s*include\s+(.*?)\s*$", re.DOTALL)
+
+# Upper bound on the number of distinct templates (and tag bodies)
+# kept in compiled form. Stream mode renders the same handful of
+# templates for every line, so the cache only needs to hold the
+# working set, not every template ever seen.
+CACHE_SIZE = 512
+
+# Below DEBUG, for what is logged for every tag rendered (and, by
+# `aina stream`, every line). Formatting those messages is only
+# worth it when they are shown, so they are logged behind a single
+# `isEnabledFor(TRACE)` check per render.
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+log = logging.getLogger(__name__)
+
+@lru_cache(maxsize=CACHE_SIZE * 4)
+def _compile(source, mode):
+    """Compile the body of a `{% %}` (mode="exec") or `{{ }}`
+    (mode="eval") tag into a code object."""
+    return compile(dedent(source).strip(), "<template>", mode)
+
+LITERAL, STATEMENT, EXPRESSION, INCLUDE = range(4)
+
+def _include(body):
+    """Return the compiled argument of `body` if it is an include tag,
+    otherwise None. Statements such as `include = 1` are left alone."""
+    match = includes.match(body)
+    if not match:
+        return None
+    try:
+        return _compile(match.group(1), "eval")
+    except SyntaxError:
+        return None
+
+def _parse_expressions(text):
+    """Split `text` into LITERAL and EXPRESSION segments."""
+    segments = []
+    parts = expressions.split(text)
+    for index in range(0, len(parts), 3):
+        if parts[index]:
+            segments.append((LITERAL, parts[index], parts[index]))
+        if index + 1 < len(parts):
+            tag, body = parts[index + 1], parts[index + 2]
+            segments.append((EXPRESSION, _compile(body, "eval"), tag))
+    return segments
+
+class Template(object):
+    """A template which has been parsed once into a list of literal
+    segments and pre-compiled code objects, ready to be rendered any
+    number of times against different namespaces.
+
+    Each segment is a tuple `(kind, value, tag)` where `kind` is one of
+    LITERAL, STATEMENT, EXPRESSION or INCLUDE, `value` is the literal
+    text or the code object and `tag` is the original text of the
+    segment. `filename`, if given, is where the template was read from
+    and relative includes are resolved from its directory."""
+
+    def __init__(self, source, filename=None):
+        self.source = str(source)
+        self.filename = filename
+        self.segments = []
+        parts = statements.split(self.source)
+        for index in range(0, len(parts), 3):
+            # Expressions are only found outside of statements, those
+            # inside a statement are part of its source code.
+            self.segments.extend(_parse_expressions(parts[index]))
+            if index + 1 < len(parts):
+                tag, body = parts[index + 1], parts[index + 2]
+                include = _include(body)
+                if include is not None:
+                    self.segments.append((INCLUDE, include, tag))
+                else:
+                    self.segments.append(
+                        (STATEMENT, _compile(body, "exec"), tag)
+                    )
+
+    def render(self, namespace=None, rescan=False):
+        """Render the template within `namespace`.
+
+        Segments are evaluated in the order in which they appear and
+        joined once at the end. If `rescan` is True, the original
+        two-stage behavior is used instead: all statements are executed
+        first, then expressions are evaluated, including any which were
+        printed by the statements."""
+        if namespace is None:
+            logging.info("No namespace given, creating empty namespace")
+            namespace = {}
+        if rescan:
+            return "".join(self._render_rescan(namespace))
+        return "".join(self.render_iter(namespace))
+
+    def render_iter(self, namespace=None, rescan=False):
+        """Like `render`, but yield the output of each segment as soon
+        as it is evaluated instead of joining them, so the output as a
+        whole is never held in memory.
+
+        With `rescan`, every statement has to run before the first
+        expression so the output of each is kept until they all have."""
+        if namespace is None:
+            logging.info("No namespace given, creating empty namespace")
+            namespace = {}
+        if rescan:
+            for chunk in self._render_rescan(namespace):
+                yield chunk
+            return
+
+        trace = log.isEnabledFor(TRACE)
+        for kind, value, tag in self.segments:
+            if kind is LITERAL:
+                yield value
+                continue
+            if trace:
+                log.log(TRACE, "Found tag {}".format(tag))
+            if kind is EXPRESSION:
+                yield self._eval(value, tag, namespace)
+            elif kind is STATEMENT:
+                yield self._exec(value, tag, namespace)
+            else:
+                for chunk in self._include(value, tag, namespace):
+                    yield chunk
+
+    def _eval(self, code, tag, namespace):
+        return str(eval(code, namespace))
+
+    def _exec(self, code, tag, namespace):
+        """Execute the statement `code` and return what it printed."""
+        with capture() as output:
+            exec(code, namespace)
+        return "".join(output)
+
+    def _include(self, code, tag, namespace, rescan=False):
+        """Render the template named by the expression `code` within
+        `namespace`."""
+        filename = os.path.expanduser(str(eval(code, namespace)))
+        if self.filename is not None:
+            filename = os.path.join(os.path.dirname(self.filename), filename)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Including {} for {}".format(filename, tag))
+        return load_template(filename).render_iter(namespace, rescan=rescan)
+
+    def _render_rescan(self, namespace):
+        out = [
+            value if kind is LITERAL else None
+            for kind, value, tag in self.segments
+        ]
+        trace = log.isEnabledFor(TRACE)
+        for index, (kind, value, tag) in enumerate(self.segments):
+            if trace and kind is not LITERAL:
+                log.log(TRACE, "Found tag {}".format(tag))
+            if kind is STATEMENT:
+                out[index] = self._exec(value, tag, namespace)
+            elif kind is INCLUDE:
+                out[index] = "".join(
+                    self._include(value, tag, namespace, rescan=True)
+                )
+        for index, (kind, value, tag) in enumerate(self.segments):
+            if kind is EXPRESSION:
+                out[index] = self._eval(value, tag, namespace)
+            elif kind is STATEMENT and "{{" in out[index]:
+                out[index] = "".join(
+                    self._eval(_value, _tag, namespace)
+                    if _kind is EXPRESSION else _value
+                    for _kind, _value, _tag in _parse_expressions(out[index])
+                )
+        return out
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_template(template):
+    """Return a `Template` for the text `template`, re-using a
+    previously compiled one when the same text is seen again."""
+    return Template(template)
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+def load_template(filename):
+    """Return a `Template` for the file `filename`.
+
+    Templates are kept in a registry shared by the whole process and
+    only read and compiled again when the file's mtime or size
+    changes, so a partial included by many templates is compiled
+    once."""
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if hasattr(sys, "audit"):
+        # Lets aina.deps know the file is an input even when it isn't
+        # opened again
+        sys.audit("aina.include", filename)
+    cached = _templates.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(filename, "r") as fin:
+        template = Template(fin.read(), filename)
+    with _templates_lock:
+        _templates[filename] = (key, template)
+    return template
+
+def render(template, namespace=None, rescan=False):
+    if not isinstance(template, Template):
+        template = compile_template(str(template))
+    return template.render(namespace, rescan=rescan)
 
-def render(template, namespace=None):
-    global cache
-    if namespace is None:
-        logging.info("No namespace given, creating empty namespace")
-        namespace = {}
-
-    out = str(template)
-    for expression in statements.findall(out):
-        logging.info("Found expression {}".format(expression[1]))
-        with stdoutIO() as output:
-            exec(dedent(expression[1]).strip(), namespace)
-            out = out.replace(expression[0], output.getvalue())
-            logging.info("output so far: {}".format(out))
-    for statement in expressions.findall(out):
-        logging.debug("Found statement {}".format(statement[1]))
-        out = out.replace(
-            statement[0],
-            str(eval(dedent(statement[1]).strip(), namespace))
-        )
-        logging.debug("output so far: {}".format(out))
-    return out
+def render_iter(template, namespace=None, rescan=False):
+    """Render `template` within `namespace`, yielding the output in
+    chunks, see `Template.render_iter`."""
+    if not isinstance(template, Template):
+        template = compile_template(str(template))
+    return template.render_iter(namespace, rescan=rescan)
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,445 @@
+"""The engine behind `aina stream`.
+
+A `Pipeline` holds the compiled hooks, tests and templates of an
+invocation along with the namespace they are evaluated in, and feeds
+the lines of each file through them. `run_parallel` spreads the same
+pipeline over a pool of worker processes.
+"""
+import os
+import sys
+import mmap
+import click
+import logging
+from types import ModuleType, FunctionType, MethodType
+from aina.render import compile_template, capture, TRACE
+from aina.hooks import compile_hooks, exec_hooks, compile_tests
+from aina.namespace import LineNamespace, LazyNamespace, make_namespace
+
+# Never in a namespace, so never the value of a key
+_MISSING = object()
+
+class Pipeline(object):
+    """The compiled form of the options given to `aina stream`.
+
+    The keyword arguments are kept as `options` so that an identical
+    pipeline can be rebuilt in another process."""
+
+    def __init__(
+            self,
+            templates=(),
+            tests=(),
+            begins=(),
+            begin_files=(),
+            begin_lines=(),
+            end_lines=(),
+            end_files=(),
+            ends=(),
+            field_sep=None,
+            namespaces=(),
+            add_env=False,
+            with_filenames=False,
+            suppress_tracebacks=False,
+            rescan=False,
+            use_mmap=True,
+            batch_size=0,
+            begin_batches=(),
+            end_batches=(),
+            cache_dir=None,
+            lazy_namespaces=False,
+            profile=False,
+            decompress=True,
+            decompress_thread=False,
+        ):
+        self.options = dict(
+            templates=templates,
+            tests=tests,
+            begins=begins,
+            begin_files=begin_files,
+            begin_lines=begin_lines,
+            end_lines=end_lines,
+            end_files=end_files,
+            ends=ends,
+            field_sep=field_sep,
+            namespaces=namespaces,
+            add_env=add_env,
+            with_filenames=with_filenames,
+            suppress_tracebacks=suppress_tracebacks,
+            rescan=rescan,
+            use_mmap=use_mmap,
+            batch_size=batch_size,
+            begin_batches=begin_batches,
+            end_batches=end_batches,
+            cache_dir=cache_dir,
+            lazy_namespaces=lazy_namespaces,
+            profile=profile,
+            decompress=decompress,
+            decompress_thread=decompress_thread,
+        )
+        self.log = logging.getLogger(__name__)
+        self.templates = [
+            compile_template(template) for template in templates
+        ]
+        self.tests = tests
+        (
+            self.begins,
+            self.begin_files,
+            self.begin_lines,
+            self.end_lines,
+            self.end_files,
+            self.ends,
+        ) = map(
+            compile_hooks,
+            (begins, begin_files, begin_lines, end_lines, end_files, ends),
+        )
+        self.batch_size = batch_size
+        self.begin_batches, self.end_batches = map(
+            compile_hooks, (begin_batches, end_batches),
+        )
+        self.field_sep = field_sep
+        self.with_filenames = with_filenames
+        self.suppress_tracebacks = suppress_tracebacks
+        self.rescan = rescan
+        self.use_mmap = use_mmap
+        self.decompress = decompress
+        self.decompress_thread = decompress_thread
+        self.base = make_namespace(
+            LazyNamespace() if lazy_namespaces else {},
+            namespaces,
+            add_env,
+            cache_dir,
+            lazy_namespaces,
+        )
+        self.emit = self.log.info
+        self.profiler = None
+        if profile:
+            from aina.profiling import Profiler
+
+            self.profiler = Profiler()
+            self.profiler.instrument(self)
+        self.reset()
+
+    def reset(self):
+        """Start over with a fresh copy of the namespace."""
+        if self.profiler is None:
+            self.namespace = LineNamespace(self.base)
+        else:
+            self.namespace = self.profiler.namespace(self.base)
+        self.namespace.set_field_sep(self.field_sep)
+        self.nr = self.fnr = 0
+        self.last_filename = None
+        self.prefilter = self.predicate = None
+        self.batch = []
+        self.trace = False
+
+    def begin(self):
+        # Checked once here rather than for every line
+        self.trace = self.log.isEnabledFor(TRACE)
+        exec_hooks(self.begins, self.namespace)
+        if self.profiler is None:
+            self.prefilter, self.predicate = compile_tests(
+                self.tests, self.namespace,
+            )
+        else:
+            self.prefilter, self.predicate = self.profiler.tests(
+                self.tests, self.namespace,
+            )
+            emit = getattr(self.emit, "__wrapped__", self.emit)
+            self.emit = self.profiler.timed("output", "emit", emit)
+
+    def end(self):
+        exec_hooks(self.ends, self.namespace)
+
+    def process_file(self, filename, start=0, end=None):
+        """Feed the lines of `filename` through the pipeline. If given,
+        only the lines starting between the byte offsets `start` and
+        `end` are processed."""
+        try:
+            with click.open_file(filename, "rb") as fin:
+                self.log.debug("Reading {}".format(filename))
+                compression = self.compression(fin)
+                if compression is not None:
+                    self.process_compressed(filename, fin, compression)
+                elif (self.use_mmap
+                        and filename != "-"
+                        and os.path.isfile(filename)
+                        # procfs and sysfs files have a size of 0
+                        and os.fstat(fin.fileno()).st_size):
+                    self.process(filename, mapped_lines(fin, start, end))
+                    self.namespace.detach()
+                elif start or end is not None:
+                    fin.seek(start)
+                    self.process(filename, _lines_between(fin, start, end))
+                else:
+                    self.process(filename, fin)
+            self.end_file()
+        except:
+            if not self.suppress_tracebacks:
+                self.log.exception("An unhandled exception occurred")
+
+    def compression(self, fin):
+        """Return the compression format of `fin`, or None."""
+        if not self.decompress:
+            return None
+        from aina.decompress import detect, peek
+
+        return detect(peek(fin))
+
+    def process_compressed(self, filename, fin, compression):
+        """Feed the lines of `fin`, compressed in `compression`, through
+        the pipeline as they are decompressed."""
+        from aina.decompress import open_decompressed, threaded_lines
+
+        self.log.debug("Decompressing {} ({})".format(filename, compression))
+        with open_decompressed(fin, compression) as decompressed:
+            if self.decompress_thread:
+                self.process(filename, threaded_lines(decompressed))
+            else:
+                self.process(filename, decompressed)
+
+    def end_file(self):
+        """Run the batch in progress and the `--end-files` hooks."""
+        self.flush_batch()
+        exec_hooks(self.end_files, self.namespace)
+
+    def resume(self, filename, fnr, name=None):
+        """Carry on with `filename` after the first `fnr` of its lines,
+        for when the lines of several files are interleaved. `name`
+        is its value of `filename` in the namespace, its absolute
+        path by default."""
+        if name is None:
+            name = os.path.abspath(filename)
+        if self.with_filenames:
+            print("===> {} <===".format(name))
+        self.namespace["filename"] = name
+        self.namespace["fnr"] = fnr
+        self.last_filename = filename
+        self.fnr = fnr
+
+    def process(self, filename, lines, name=None):
+        """Feed each line in `lines`, read from `filename`, through the
+        pipeline. See `resume` for `name`."""
+        log, trace = self.log, self.trace
+        namespace = self.namespace
+        prefilter, predicate = self.prefilter, self.predicate
+        begin_lines, end_lines = self.begin_lines, self.end_lines
+        batch_size = self.batch_size
+        nr, fnr = self.nr, self.fnr
+        # The last line rejected by the prefilter, which is only set in
+        # the namespace if it turns out to be the last line of all
+        skipped = None
+        if self.profiler is not None:
+            lines = self.profiler.iterate("input", "read", lines)
+        try:
+            for line in lines:
+                if trace:
+                    log.log(TRACE, "Got line: {}".format(bytes(line)))
+                if filename != self.last_filename:
+                    self.resume(filename, 0, name)
+                    fnr = 0
+                    exec_hooks(self.begin_files, namespace)
+                fnr, nr = fnr + 1, nr + 1
+                passed = prefilter is None or prefilter(line)
+                if not passed and not end_lines:
+                    # Nothing else needs to see this line
+                    skipped = line
+                    continue
+                skipped = None
+                namespace.set_line(line, nr, fnr)
+                if passed and (predicate is None or predicate(namespace)):
+                    exec_hooks(begin_lines, namespace)
+                    if not batch_size:
+                        self.render_templates()
+                    else:
+                        self.batch.append(bytes(line))
+                        if len(self.batch) >= batch_size:
+                            self.flush_batch()
+                exec_hooks(end_lines, namespace)
+        finally:
+            if skipped is not None:
+                # So --end-files and --ends see the last line
+                namespace.set_line(skipped, nr, fnr)
+            self.nr, self.fnr = nr, fnr
+
+    def flush_batch(self):
+        """Hand the lines collected so far to the batch hooks and
+        templates, which run once for the whole batch."""
+        if not self.batch:
+            return
+        self.namespace.set_batch(self.batch)
+        self.batch = []
+        exec_hooks(self.begin_batches, self.namespace)
+        self.render_templates()
+        exec_hooks(self.end_batches, self.namespace)
+
+    def render_templates(self):
+        log, trace = self.log, self.trace
+        for template in self.templates:
+            if trace:
+                log.log(
+                    TRACE, "Rendering template: {}".format(template.source),
+                )
+            try:
+                results = template.render(
+                    self.namespace, rescan=self.rescan,
+                ).strip()
+            except:
+                if not self.suppress_tracebacks:
+                    log.exception("An unhandled exception occurred")
+                continue
+            if trace:
+                log.log(TRACE, "Result: {}".format(results))
+            if results:
+                self.emit(results)
+
+    def state(self):
+        """Return the values which were set or rebound in the namespace
+        since it was copied from `base`, to be sent to another process,
+        leaving out modules, functions and the values which are specific
+        to the current line. Values which can't be pickled are reported
+        when the state is sent."""
+        base = self.base
+        state = {}
+        for key, value in self.namespace.items():
+            if (key.startswith("__")
+                    or value is base.get(key, _MISSING)
+                    or key in LineNamespace.LAZY
+                    or key in LineNamespace.BATCH
+                    or isinstance(value, (
+                        ModuleType, FunctionType, MethodType, type,
+                    ))):
+                continue
+            state[key] = value
+        return state
+
+def mapped_lines(fin, start=0, end=None):
+    """Yield the lines of the regular file `fin` which begin between
+    the byte offsets `start` and `end` as `memoryview` slices of a
+    memory map of the file, without copying them.
+
+    The map is released once nothing refers to any of the slices.
+    If the file is truncated while it is mapped, as by copytruncate
+    log rotation, touching the pages which were cut off raises SIGBUS
+    and kills the process."""
+    size = os.fstat(fin.fileno()).st_size
+    if not size:
+        return
+    mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    find = mapped.find
+    position = start
+    end = size if end is None else min(end, size)
+    while position < end:
+        newline = find(b"\n", position)
+        stop = size if newline == -1 else newline + 1
+        yield view[position:stop]
+        position = stop
+
+def _lines_between(fin, start, end):
+    """Yield the lines of `fin`, positioned at `start`, which begin
+    before the byte offset `end`."""
+    position = start
+    for line in fin:
+        if end is not None and position >= end:
+            break
+        position += len(line)
+        yield line
+
+def split_file(filename, chunk_size):
+    """Split `filename` into `(filename, start, end)` tasks of roughly
+    `chunk_size` bytes, with every boundary just after a newline."""
+    if filename == "-" or not chunk_size or not os.path.isfile(filename):
+        return [(filename, 0, None)]
+    size = os.path.getsize(filename)
+    if size <= chunk_size:
+        return [(filename, 0, None)]
+    from aina.decompress import detect
+
+    with open(filename, "rb") as fin:
+        if detect(fin.read(6)) is not None:
+            # Compressed files can only be read from the start
+            return [(filename, 0, None)]
+    boundaries = [0]
+    with open(filename, "rb") as fin:
+        while boundaries[-1] + chunk_size < size:
+            fin.seek(boundaries[-1] + chunk_size)
+            fin.readline()
+            if fin.tell() >= size:
+                break
+            boundaries.append(fin.tell())
+    boundaries.append(None)
+    return [
+        (filename, start, end)
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
+
+_pipeline = None
+
+def _init_worker(options, add_paths):
+    global _pipeline
+    for path in add_paths:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    _pipeline = Pipeline(**options)
+
+def _run_task(task):
+    """Process one `(filename, start, end)` task in a fresh namespace
+    and return what was printed, the rendered results, what was set
+    in the namespace and, with `profile`, its timings."""
+    _pipeline.reset()
+    results = []
+    with capture():
+        # Only rebuilds the namespace, what --begins prints was
+        # already printed once by the parent
+        _pipeline.begin()
+    _pipeline.emit = results.append
+    with capture() as printed:
+        _pipeline.process_file(*task)
+    stats = None if _pipeline.profiler is None else _pipeline.profiler.take()
+    return "".join(printed), results, _pipeline.state(), stats
+
+def run_parallel(
+    pipeline,
+    filenames,
+    jobs,
+    chunk_size=0,
+    ordered=True,
+    merges=(),
+    add_paths=(),
+):
+    """Process `filenames` with `jobs` worker processes.
+
+    Each task (a file, or a chunk of one if `chunk_size` is given) is
+    processed by a copy of `pipeline` with a namespace of its own.
+    As each task completes, whatever it printed is written to stdout,
+    its results are passed to `pipeline.emit` and the `merges` hooks
+    are executed in the namespace of `pipeline` with the final state
+    of the task's namespace available as `worker`. If `ordered` is
+    False, tasks are handled in the order in which they complete."""
+    from multiprocessing import Pool
+
+    merges = compile_hooks(merges)
+    tasks = [
+        task
+        for filename in filenames
+        for task in split_file(filename, chunk_size)
+    ]
+    pool = Pool(
+        jobs,
+        initializer=_init_worker,
+        initargs=(pipeline.options, list(add_paths)),
+    )
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for printed, results, state, stats in imap(_run_task, tasks):
+            if stats and pipeline.profiler is not None:
+                pipeline.profiler.merge(stats)
+            if printed:
+                sys.stdout.write(printed)
+            for result in results:
+                pipeline.emit(result)
+            pipeline.namespace["worker"] = state
+            exec_hooks(merges, pipeline.namespace)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,224 @@
+"""Watch a tree of templates for changes.
+
+`aina doc --interval` uses a `Watcher` to learn which templates have
+changed instead of walking and stat()ing the whole tree on every
+tick. On Linux the kernel tells us through inotify, everywhere else
+(or with `poll=True`) the tree is polled every `interval` seconds.
+"""
+import os
+import sys
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+from time import time, sleep
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct("iIII")
+
+class Watcher(object):
+    """Base class of the watchers, `wait` returns the set of paths
+    which have changed."""
+
+    def __init__(self, path, recursive=False, interval=1, debounce=0.05):
+        self.path = os.path.abspath(path)
+        self.recursive = recursive
+        self.interval = interval
+        self.debounce = debounce
+        # When watching a single file, its directory is watched and
+        # everything else in it ignored, so the file can be replaced
+        # (as many editors do) without losing track of it.
+        if os.path.isdir(self.path):
+            self.root, self.only = self.path, None
+        else:
+            self.root, self.only = os.path.dirname(self.path), self.path
+        self.extra = set()
+
+    def wanted(self, path):
+        return self.only is None or path == self.only or path in self.extra
+
+    def watch_files(self, paths):
+        """Also report changes to the files `paths`, wherever they are."""
+        self.extra.update(os.path.abspath(path) for path in paths)
+
+    def wait(self, timeout=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class InotifyWatcher(Watcher):
+    """Watcher which relies on inotify. Once a change is seen, it
+    keeps collecting changes until none arrive for `debounce` seconds
+    so a burst of writes results in one re-render."""
+
+    def __init__(self, *args, **kwargs):
+        super(InotifyWatcher, self).__init__(*args, **kwargs)
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        self.extra_directories = set()
+        self.add_directory(self.root)
+        if self.recursive and self.only is None:
+            for root, dirs, filenames in os.walk(self.root):
+                for dirname in dirs:
+                    self.add_directory(os.path.join(root, dirname))
+
+    def add_directory(self, path, extra=False):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), WATCH_MASK,
+        )
+        if wd < 0:
+            raise OSError(
+                ctypes.get_errno(), "inotify_add_watch failed", path,
+            )
+        if wd not in self.directories and extra:
+            self.extra_directories.add(wd)
+        elif not extra:
+            self.extra_directories.discard(wd)
+        self.directories[wd] = path
+
+    def watch_files(self, paths):
+        paths = set(os.path.abspath(path) for path in paths) - self.extra
+        super(InotifyWatcher, self).watch_files(paths)
+        watched = set(self.directories.values())
+        for directory in set(os.path.dirname(path) for path in paths):
+            if directory not in watched and os.path.isdir(directory):
+                self.add_directory(directory, extra=True)
+
+    def wait(self, timeout=None):
+        changed = set()
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            if changed:
+                remaining = self.debounce
+            elif deadline is None:
+                remaining = None
+            else:
+                remaining = max(0, deadline - time())
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return changed
+            changed.update(self.read())
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return set()
+            raise
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, fall back to everything
+                changed.update(_walk(self.root, self.recursive))
+                continue
+            if wd not in self.directories:
+                continue
+            path = os.path.join(self.directories[wd], os.fsdecode(name))
+            if wd in self.extra_directories:
+                if path in self.extra:
+                    changed.add(path)
+                continue
+            if mask & IN_ISDIR:
+                if (self.recursive
+                        and self.only is None
+                        and mask & (IN_CREATE | IN_MOVED_TO)):
+                    self.add_directory(path)
+                    changed.add(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self.wanted(path):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(Watcher):
+    """Watcher which compares the mtime and size of every file in the
+    tree every `interval` seconds."""
+
+    def __init__(self, *args, **kwargs):
+        super(PollingWatcher, self).__init__(*args, **kwargs)
+        self.snapshot = self.take_snapshot()
+
+    def watch_files(self, paths):
+        super(PollingWatcher, self).watch_files(paths)
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        paths = list(_walk(self.root, self.recursive)) + sorted(self.extra)
+        for path in paths:
+            if not self.wanted(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            if deadline is None:
+                sleep(self.interval)
+            else:
+                sleep(max(0, min(self.interval, deadline - time())))
+            snapshot = self.take_snapshot()
+            changed = set(
+                path for path, stat in snapshot.items()
+                if self.snapshot.get(path) != stat
+            )
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time() >= deadline):
+                return changed
+
+def _walk(root, recursive):
+    """Yield every file (and, if `recursive`, directory) in `root`."""
+    for _root, dirs, filenames in os.walk(root):
+        for filename in filenames:
+            yield os.path.join(_root, filename)
+        if recursive:
+            for dirname in dirs:
+                yield os.path.join(_root, dirname)
+        else:
+            dirs.clear()
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32,
+    ]
+    return libc
+
+def watch(path, recursive=False, interval=1, debounce=0.05, poll=False):
+    """Return the best `Watcher` available for `path`."""
+    log = logging.getLogger(__name__)
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path, recursive, interval, debounce)
+        except (OSError, AttributeError) as e:
+            log.warning(
+                "inotify is unavailable ({}), polling instead".format(e)
+            )
+    return PollingWatcher(path, recursive, interval, debounce)
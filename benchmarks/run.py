@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the hot paths of aina.
+
+Every case runs in a fresh interpreter so its peak RSS can be
+measured on its own, and the best of `--repeat` runs is kept. The
+results are written as JSON so that two runs, for instance of two
+commits, can be compared with `--compare`::
+
+    $ python benchmarks/run.py --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/run.py --output after.json
+    $ python benchmarks/run.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# name: (kind, parameters)
+CASES = {
+    "render-10-tags-1k": ("render", {"tags": 10, "size": 1 << 10}),
+    "render-100-tags-1k": ("render", {"tags": 100, "size": 1 << 10}),
+    "render-10-tags-100k": ("render", {"tags": 10, "size": 100 << 10}),
+    "render-1000-tags-100k": ("render", {"tags": 1000, "size": 100 << 10}),
+    "stream-grep": ("stream", {"args": [
+        "--tests", "'ERROR' in line",
+        "--templates", "{{line.rstrip()}}",
+        "--output", "-",
+    ]}),
+    "stream-grep-logging": ("stream", {"args": [
+        "--tests", "'ERROR' in line",
+        "--templates", "{{line.rstrip()}}",
+    ]}),
+    "stream-awk": ("stream", {"args": [
+        "--templates", "{{fields[0].decode()}} {{fields[4].decode()}}",
+        "--output", "-",
+    ]}),
+    "stream-wc": ("stream", {"args": [
+        "--begins", "lines = words = 0",
+        "--end-lines", "lines += 1; words += nf",
+        "--ends", "print(lines, words)",
+    ]}),
+    "doc-10": ("doc", {"files": 10}),
+    "doc-1k": ("doc", {"files": 1000}),
+    "doc-10k": ("doc", {"files": 10000}),
+    "doc-1k-cached": ("doc", {"files": 1000, "cached": True}),
+}
+
+# Left out by --quick
+SLOW = ("doc-10k",)
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf")
+
+
+def make_log(filename, lines):
+    """Write a synthetic log of `lines` lines to `filename`."""
+    rng = random.Random(0)
+    with open(filename, "w") as fout:
+        for nr in range(lines):
+            fout.write("2019-01-01T00:00:{:02d} host{} {} pid={} {}\n".format(
+                nr % 60,
+                rng.randrange(16),
+                rng.choice(LEVELS),
+                rng.randrange(1 << 16),
+                " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12))),
+            ))
+
+
+def make_tree(root, files):
+    """Create a directory `src` of `files` templates spread over
+    subdirectories of 100 files, and a namespace file for them."""
+    src = os.path.join(root, "src")
+    for index in range(files):
+        directory = os.path.join(src, "d{:03d}".format(index // 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "f{:05d}.conf".format(index)), "w") as fout:
+            fout.write(
+                "# {{name}} {}\n"
+                "{{% port = base + {} %}}"
+                "listen {{{{port}}}}\n"
+                "{{% for host in hosts: print('server', host) %}}\n".format(index, index)
+            )
+    with open(os.path.join(root, "namespace"), "w") as fout:
+        fout.write(repr({
+            "name": "benchmark",
+            "base": 8000,
+            "hosts": ["host{}".format(n) for n in range(10)],
+        }))
+
+
+def make_template(tags, size):
+    """Return a template of about `size` characters with `tags` tags,
+    half expressions and half statements."""
+    filler = max(0, size // max(tags, 1) - 24)
+    parts = []
+    for index in range(tags):
+        parts.append("x" * filler)
+        if index % 2:
+            parts.append("{% print(n + " + str(index) + ") %}")
+        else:
+            parts.append("{{str(n * " + str(index) + ")}}")
+    return "".join(parts)
+
+
+def run_render(workdir, tags, size):
+    from aina import render, compile_template
+
+    template = make_template(tags, size)
+    namespace = {"n": 1}
+    compile_template(template)
+    count, total = 0, 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 1:
+        total += len(render(template, namespace))
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "renders_per_s": count / elapsed, "bytes_per_s": total / elapsed}
+
+
+def _cli(args):
+    """Run the aina CLI in this process with its output discarded."""
+    from aina.aina import cli
+
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        cli.main(args, standalone_mode=False)
+    finally:
+        sys.stdout.flush()
+
+
+def run_stream(workdir, args):
+    lines = sum(1 for _ in open(os.path.join(workdir, "log")))
+    start = time.perf_counter()
+    _cli(["stream"] + args + [os.path.join(workdir, "log")])
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "lines_per_s": lines / elapsed}
+
+
+def run_doc(workdir, files, cached=False):
+    dst = os.path.join(workdir, "dst")
+    args = [
+        "doc",
+        "--recursive",
+        "--namespaces", os.path.join(workdir, "namespace"),
+        os.path.join(workdir, "src"),
+        dst,
+    ]
+    if cached:
+        args[1:1] = ["--cache-dir", os.path.join(workdir, "cache")]
+    shutil.rmtree(dst, ignore_errors=True)
+    os.mkdir(dst)
+    if cached:
+        # Fill the cache, only the run which follows is measured
+        subprocess.check_call(
+            [sys.executable, "-c", "import sys; from aina.aina import cli; cli(sys.argv[1:])"] + args,
+            stdout=subprocess.DEVNULL,
+        )
+    start = time.perf_counter()
+    _cli(args)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "files_per_s": files / elapsed}
+
+
+RUNNERS = {"render": run_render, "stream": run_stream, "doc": run_doc}
+
+
+def run_case(name, workdir):
+    """Run the case `name` in a new interpreter and return its
+    results, including its peak RSS in KiB."""
+    kind, parameters = CASES[name]
+    result = os.path.join(workdir, "result.json")
+    process = subprocess.Popen(
+        [sys.executable, "-W", "ignore", __file__, "--run-case", name, "--workdir", workdir, "--result", result],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))),
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    if status:
+        raise RuntimeError("Benchmark {} failed".format(name))
+    with open(result) as fin:
+        results = json.load(fin)
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    results["peak_rss_kib"] = usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1)
+    return results
+
+
+def prepare(kind, parameters, workdir, lines):
+    if kind == "stream" and not os.path.exists(os.path.join(workdir, "log")):
+        make_log(os.path.join(workdir, "log"), lines)
+    elif kind == "doc":
+        shutil.rmtree(os.path.join(workdir, "src"), ignore_errors=True)
+        shutil.rmtree(os.path.join(workdir, "cache"), ignore_errors=True)
+        make_tree(workdir, parameters["files"])
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat, lines):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="aina-bench-")
+    try:
+        for name in names:
+            kind, parameters = CASES[name]
+            prepare(kind, parameters, workdir, lines)
+            runs = [run_case(name, workdir) for _ in range(repeat)]
+            best = min(runs, key=lambda result: result["seconds"])
+            best["peak_rss_kib"] = max(result["peak_rss_kib"] for result in runs)
+            results[name] = best
+            print("{:24} {}".format(name, _summary(best)), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stream_lines": lines,
+        "results": results,
+    }
+
+
+def _summary(result):
+    rates = ["{}={:.0f}".format(key, value) for key, value in sorted(result.items()) if key.endswith("_per_s")]
+    return "{:.3f}s {} peak_rss_kib={}".format(result["seconds"], " ".join(rates), result["peak_rss_kib"])
+
+
+def compare(before, after):
+    """Print the change of every rate between two result files."""
+    with open(before) as fin:
+        before = json.load(fin)
+    with open(after) as fin:
+        after = json.load(fin)
+    print("{:24} {:>14} {:>14} {:>14} {:>8}".format("case", "metric", "before", "after", "change"))
+    for name, result in sorted(after["results"].items()):
+        old = before["results"].get(name)
+        if old is None:
+            continue
+        for key in sorted(result):
+            if key == "seconds" or key not in old:
+                continue
+            change = (result[key] - old[key]) / old[key] * 100 if old[key] else 0
+            print("{:24} {:>14} {:>14.0f} {:>14.0f} {:>+7.1f}%".format(name, key, old[key], result[key], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="cases to run, all by default")
+    parser.add_argument("--output", "-o", help="write the results to this file")
+    parser.add_argument("--repeat", "-r", type=int, default=3)
+    parser.add_argument("--lines", type=int, default=200000, help="lines in the stream benchmarks' log")
+    parser.add_argument("--quick", action="store_true", help="fewer lines, no large trees")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        kind, parameters = CASES[args.run_case]
+        results = RUNNERS[kind](args.workdir, **parameters)
+        with open(args.result, "w") as fout:
+            json.dump(results, fout)
+        return 0
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if args.list:
+        print("\n".join(CASES))
+        return 0
+
+    names = args.cases or [name for name in CASES if not (args.quick and name in SLOW)]
+    unknown = set(names) - set(CASES)
+    if unknown:
+        parser.error("unknown cases: {}".format(", ".join(sorted(unknown))))
+    lines = min(args.lines, 20000) if args.quick else args.lines
+    results = run(names, 1 if args.quick else args.repeat, lines)
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,10 +2,19 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `aina doc` command."""
+import os
+import sys
+import json
+import shutil
 import unittest
 import logging
+import tempfile
+import subprocess
 from pathlib import Path
+from unittest import mock
 from aina.aina import cli
+from aina.doc import render_file, render_src, dependencies
+from aina.output import write_atomic
 from click.testing import CliRunner
 
 
@@ -229,3 +238,242 @@ class TestainaDoc(unittest.TestCase):
             expected = "foo"
             self.assertEqual(expected, result)
             self.assertIn("'x': 5", output.output)
+
+    def test_only_rerenders_when_inputs_change(self):
+        """Test that a file is rendered again only when the content of
+        the template or of a file it read changes."""
+        dependencies.clear()
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("data").write_text("first")
+            Path("src").write_text("{% print(open('data').read()) %}")
+            render_file("src", "dst", {})
+            self.assertEqual("first\n", Path("dst").read_text())
+
+            os.utime("dst", (0, 0))
+            os.utime("src", (0, 0))
+            os.utime("data", (0, 0))
+            render_file("src", "dst", {})
+            self.assertEqual(0, os.stat("dst").st_mtime)
+
+            Path("data").write_text("second")
+            render_file("src", "dst", {})
+            self.assertEqual("second\n", Path("dst").read_text())
+
+            Path("dst").write_text("modified")
+            render_file("src", "dst", {})
+            self.assertEqual("second\n", Path("dst").read_text())
+
+    def test_includes_are_inputs(self):
+        """Test that changing an included template renders the files
+        which include it again, even though it is only read once."""
+        dependencies.clear()
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("src").mkdir()
+            Path("dst").mkdir()
+            Path("partial").write_text("<{{name}}>")
+            Path("src/first").write_text("{% name = 'first' %}{% include '../partial' %}")
+            Path("src/second").write_text("{% name = 'second' %}{% include '../partial' %}")
+            render_src(Path("src").resolve(), Path("dst"), False, {})
+            self.assertEqual("<first>", Path("dst/first").read_text())
+            self.assertEqual("<second>", Path("dst/second").read_text())
+
+            Path("partial").write_text("[[{{name}}]]")
+            render_src(Path("src").resolve(), Path("dst"), False, {})
+            self.assertEqual("[[first]]", Path("dst/first").read_text())
+            self.assertEqual("[[second]]", Path("dst/second").read_text())
+
+    def test_cache_dir(self):
+        """Test that with --cache-dir, a later run only renders the
+        files whose inputs changed since the previous one."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("src").mkdir()
+            Path("dst").mkdir()
+            Path("src/first").write_text("this is a {{test}}")
+            Path("src/second").write_text("this is another {{test}}")
+            Path("namespace").write_text("{'test': 'foo'}")
+            args = (
+                "doc",
+                "--namespaces", "namespace",
+                "--cache-dir", "cache",
+                "src",
+                "dst",
+            )
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            self.assertTrue(Path("cache/index.json").is_file())
+            os.utime("dst/first", (0, 0))
+            os.utime("dst/second", (0, 0))
+
+            dependencies.clear()
+            Path("src/second").write_text("this is yet another {{test}}")
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            self.assertEqual(0, os.stat("dst/first").st_mtime)
+            self.assertEqual("this is yet another foo", Path("dst/second").read_text())
+
+            dependencies.clear()
+            Path("namespace").write_text("{'test': 'bar'}")
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            self.assertEqual("this is a bar", Path("dst/first").read_text())
+
+            os.utime("dst/first", (0, 0))
+            fingerprint = json.loads(Path("cache/index.json").read_text())["fingerprint"]
+            dependencies.clear()
+            output = runner.invoke(cli, args=args + ("--add-env",))
+            self.assertIs(output.exception, None)
+            index = json.loads(Path("cache/index.json").read_text())
+            self.assertNotEqual(fingerprint, index["fingerprint"])
+            # Rendered again, but identical so not rewritten
+            self.assertEqual(0, os.stat("dst/first").st_mtime)
+
+    def test_cache_dir_renders_failures_again(self):
+        """Test that with --cache-dir, a file which failed to render is
+        rendered again by the next run rather than left stale."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("src").write_text("v={{x}}")
+            args = (
+                "doc",
+                "--begins", "x = 1",
+                "--cache-dir", "cache",
+                "src",
+                "dst",
+            )
+            dependencies.clear()
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            self.assertEqual("v=1", Path("dst").read_text())
+
+            Path("src").write_text("v={{x}} {{undefined_name}}")
+            for _ in range(2):
+                dependencies.clear()
+                output = runner.invoke(cli, args=args)
+                self.assertIsInstance(output.exception, NameError)
+            index = json.loads(Path("cache/index.json").read_text())
+            self.assertEqual({}, index["outputs"])
+
+            Path("src").write_text("v={{x}}!")
+            dependencies.clear()
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            self.assertEqual("v=1!", Path("dst").read_text())
+
+    def test_writes_are_atomic_and_skipped_when_unchanged(self):
+        """Test that outputs are replaced rather than rewritten, keep
+        their permissions and aren't written at all when identical."""
+        dependencies.clear()
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("src").write_text("this is a {{test}}")
+            Path("dst").write_text("old")
+            os.chmod("dst", 0o640)
+            inode = os.stat("dst").st_ino
+            render_file("src", "dst", {"test": "foo"})
+            self.assertEqual("this is a foo", Path("dst").read_text())
+            self.assertNotEqual(inode, os.stat("dst").st_ino)
+            self.assertEqual(0o640, os.stat("dst").st_mode & 0o777)
+            self.assertEqual(["dst", "src"], sorted(os.listdir(".")))
+
+            os.utime("dst", (0, 0))
+            dependencies.clear()
+            render_file("src", "dst", {"test": "foo"})
+            self.assertEqual(0, os.stat("dst").st_mtime)
+
+            Path("src").write_text("this is a {{test}}{{1 / 0}}")
+            with self.assertRaises(ZeroDivisionError):
+                render_file("src", "dst", {"test": "foo"})
+            self.assertEqual("this is a foo", Path("dst").read_text())
+            self.assertEqual(["dst", "src"], sorted(os.listdir(".")))
+            # A render which failed is attempted again
+            with self.assertRaises(ZeroDivisionError):
+                render_file("src", "dst", {"test": "foo"})
+
+    def test_write_atomic_skips_unchanged_without_a_temporary_file(self):
+        """Test that with `skip_unchanged`, identical data creates no
+        temporary file and different data is written in full."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("dst").write_bytes(b"abcdef")
+            with mock.patch("tempfile.mkstemp") as mkstemp:
+                self.assertFalse(write_atomic(
+                    "dst", [b"ab", b"", b"cd", b"ef"], skip_unchanged=True,
+                ))
+            mkstemp.assert_not_called()
+            for chunks in (
+                    [b"ab", b"cX", b"ef"],
+                    [b"abcd"],
+                    [b"abcdef", b"gh"],
+                    [b"X"],
+                    []):
+                Path("dst").write_bytes(b"abcdef")
+                self.assertTrue(
+                    write_atomic("dst", chunks, skip_unchanged=True)
+                )
+                self.assertEqual(b"".join(chunks), Path("dst").read_bytes())
+                self.assertEqual(["dst"], os.listdir("."))
+            self.assertTrue(write_atomic("new", b"x", skip_unchanged=True))
+            self.assertEqual(b"x", Path("new").read_bytes())
+
+    def test_parallel_jobs(self):
+        """Test that --jobs renders every file with a namespace prepared
+        in each worker, and reports all the failures together."""
+        dependencies.clear()
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("src").mkdir()
+            Path("dst").mkdir()
+            for i in range(8):
+                Path("src/{}".format(i)).write_text("{}: {{{{test}}}} {{{{sep.join('ab')}}}}".format(i))
+            Path("namespace").write_text("{'test': 'foo'}")
+            args = (
+                "doc",
+                "--jobs", "2",
+                "--begins", "sep = '-'",
+                "--namespaces", "namespace",
+                "src",
+                "dst",
+            )
+            output = runner.invoke(cli, args=args)
+            self.assertIs(output.exception, None)
+            for i in range(8):
+                self.assertEqual("{}: foo a-b".format(i), Path("dst/{}".format(i)).read_text())
+
+            Path("src/3").write_text("{{missing}}")
+            Path("src/5").write_text("{{1 / 0}}")
+            output = runner.invoke(cli, args=args)
+            self.assertEqual(1, output.exit_code)
+            self.assertIn("2 of 8 files failed to render", output.output)
+
+    def test_parallel_jobs_print_begins_once(self):
+        """Test what --begins prints is shown once with --jobs, although
+        every worker runs it again."""
+        root = Path(tempfile.mkdtemp())
+        try:
+            (root / "src").mkdir()
+            (root / "dst").mkdir()
+            for i in range(4):
+                (root / "src" / str(i)).write_text("{{i}}")
+            # The workers inherit the real stdout, not the runner's
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; from aina.aina import cli; cli(sys.argv[1:])",
+                    "doc",
+                    "--jobs", "2",
+                    "--begins", "print('HEADER'); i = 1",
+                    str(root / "src"),
+                    str(root / "dst"),
+                ],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
+            self.assertEqual(1, output.stdout.count("HEADER"))
+            self.assertEqual("1", (root / "dst" / "3").read_text())
+        finally:
+            shutil.rmtree(str(root))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `aina.follow` module."""
+import os
+import socket
+import shutil
+import asyncio
+import logging
+import tempfile
+import unittest
+from aina.aina import cli
+from aina.follow import Follower
+from aina.stream import Pipeline
+from click.testing import CliRunner
+
+
+class TestFollower(unittest.TestCase):
+    """Tests for `Follower`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.root = tempfile.mkdtemp()
+        self.pipeline = Pipeline(
+            templates=["{{filename}} {{fnr}} {{line.strip()}}"],
+            begins=["ended = []"],
+            end_files=["ended.append((filename, fnr))"],
+        )
+        self.results = []
+        self.pipeline.emit = self.results.append
+        self.pipeline.begin()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, text, mode="a"):
+        with open(self.path(name), mode) as fout:
+            fout.write(text)
+
+    def follow(self, specs, *steps, **kwargs):
+        """Follow `specs` while taking each of `steps` in turn, leaving
+        time in between for the follower to catch up."""
+        follower = Follower(self.pipeline, specs, interval=0.01, **kwargs)
+
+        async def scenario():
+            task = asyncio.ensure_future(follower.run())
+            for step in steps:
+                await asyncio.sleep(0.1)
+                step()
+            await asyncio.sleep(0.1)
+            follower.stopped.set()
+            await task
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(scenario())
+        finally:
+            loop.close()
+        return self.pipeline.namespace["ended"]
+
+    def test_files(self):
+        """Test lines appended to several files are seen with the fnr of
+        their own file, including across rotation and truncation."""
+        self.write("a", "old\n")
+        a, b = self.path("a"), self.path("b")
+        ended = self.follow(
+            [a, b],
+            lambda: self.write("a", "a1\n"),
+            lambda: self.write("b", "b1\nb2"),
+            lambda: self.write("a", "a2\n"),
+            lambda: (os.rename(a, a + ".1"), self.write("a.1", "a3\n"), self.write("a", "new\n")),
+            lambda: self.write("b", "\nb3\n", "w"),
+        )
+        self.assertEqual(
+            [
+                a + " 1 a1",
+                b + " 1 b1",
+                a + " 2 a2",
+                a + " 3 a3",
+                a + " 1 new",
+                b + " 2 b2",
+                b + " 1",
+                b + " 2 b3",
+            ],
+            self.results,
+        )
+        self.assertEqual([(a, 3), (b, 2), (a, 1), (b, 2)], ended)
+
+    def test_from_start(self):
+        """Test existing lines are only read with `from_start`."""
+        self.write("a", "old\n")
+        self.follow([self.path("a")], from_start=True)
+        self.assertEqual([self.path("a") + " 1 old"], self.results)
+
+    def test_sockets_and_fifos(self):
+        """Test every connection to a socket, and every writer of a
+        FIFO, is a file of its own."""
+        spec = "unix:" + self.path("socket")
+        fifo = self.path("fifo")
+        os.mkfifo(fifo)
+
+        def send(data):
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(self.path("socket"))
+            client.sendall(data)
+            client.close()
+
+        ended = self.follow(
+            [spec, fifo],
+            lambda: send(b"s1\ns2"),
+            lambda: self.write("fifo", "f1\n"),
+            lambda: send(b"s3\n"),
+        )
+        self.assertEqual(
+            [spec + " 1 s1", spec + " 2 s2", fifo + " 1 f1", spec + " 1 s3"],
+            self.results,
+        )
+        self.assertEqual([(spec, 2), (fifo, 1), (spec, 1)], ended)
+        self.assertFalse(os.path.exists(self.path("socket")))
+
+
+class TestainaStreamFollow(unittest.TestCase):
+    """Tests for `aina stream --follow`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        logging.getLogger("").handlers = []
+
+    def test_stdin(self):
+        """Test `--follow` ends once its only source, stdin, does."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--follow",
+                "--templates", "{{filename}} {{fnr}} {{line.strip()}}",
+                "--end-files", "print('end', fnr)",
+                "-",
+            ),
+            input="foo\nbar",
+        )
+        self.assertEqual("- 1 foo\n- 2 bar\nend 2\n", result.output)
+
+    def test_jobs(self):
+        """Test `--follow` can't be used with `--jobs`."""
+        result = CliRunner().invoke(cli, args=("stream", "--follow", "--jobs", "2", "log"))
+        self.assertNotEqual(0, result.exit_code)
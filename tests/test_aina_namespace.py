@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `aina.namespace` module."""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from aina.namespace import (
+    load_namespace,
+    make_namespace,
+    LazyNamespace,
+    LineNamespace,
+    NamespaceIndex,
+)
+
+
+class TestLoadNamespace(unittest.TestCase):
+    """Tests for `load_namespace`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        filename = os.path.join(self.root, name)
+        with open(filename, "w") as fout:
+            fout.write(text)
+        return filename
+
+    def test_loaders_by_extension(self):
+        """Test JSON, literal and Python namespace files."""
+        self.assertEqual(
+            {"test": [1, None]},
+            load_namespace(self.write("ns.json", '{"test": [1, null]}')),
+        )
+        self.assertEqual(
+            {"test": (1, None)},
+            load_namespace(self.write("namespace", "{'test': (1, None)}")),
+        )
+        self.assertEqual(
+            {"test": "foo"},
+            load_namespace(self.write("ns.py", "{'test': prefix + 'o'}"), {"prefix": "fo"}),
+        )
+
+    def test_non_literal_falls_back_to_eval(self):
+        """Test a namespace file which isn't a literal is evaluated in
+        the namespace, as it always was."""
+        filename = self.write("namespace", "{'test': str(x + 1)}")
+        self.assertEqual({"test": "2"}, load_namespace(filename, {"x": 1}))
+        namespace = make_namespace({"x": 1}, [filename], False)
+        self.assertEqual("2", namespace["test"])
+
+    def test_cache(self):
+        """Test parsed literals are cached by content and Python files
+        are never cached."""
+        cache_dir = os.path.join(self.root, "cache")
+        filename = self.write("namespace", "{'test': 'foo'}")
+        self.assertEqual({"test": "foo"}, load_namespace(filename, cache_dir=cache_dir))
+        cached = os.listdir(os.path.join(cache_dir, "namespaces"))
+        self.assertEqual(1, len(cached))
+
+        # Prove the cache is what is read the next time around
+        with open(os.path.join(cache_dir, "namespaces", cached[0]), "wb") as fout:
+            pickle.dump({"test": "cached"}, fout)
+        self.assertEqual({"test": "cached"}, load_namespace(filename, cache_dir=cache_dir))
+
+        self.write("namespace", "{'test': 'bar'}")
+        self.assertEqual({"test": "bar"}, load_namespace(filename, cache_dir=cache_dir))
+
+        load_namespace(self.write("ns.py", "{'test': 'foo'}"), cache_dir=cache_dir)
+        self.assertEqual(2, len(os.listdir(os.path.join(cache_dir, "namespaces"))))
+
+
+class TestLazyNamespace(unittest.TestCase):
+    """Tests for `LazyNamespace` and `make_namespace(lazy=True)`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, "cache")
+        self.first = os.path.join(self.root, "first")
+        with open(self.first, "w") as fout:
+            fout.write("{'a': [1, 2], 'b': 'first'}")
+        self.second = os.path.join(self.root, "second.json")
+        with open(self.second, "w") as fout:
+            fout.write('{"b": "second", "c": null}')
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.root)
+
+    def make(self, namespace=None, namespaces=None, add_env=False):
+        return make_namespace(
+            LazyNamespace(namespace or {}),
+            [self.first, self.second] if namespaces is None else namespaces,
+            add_env,
+            self.cache_dir,
+            lazy=True,
+        )
+
+    def test_values_are_loaded_when_used(self):
+        """Test nothing but the keys is loaded upfront, and later files
+        take precedence as they would if they were copied in."""
+        namespace = self.make({"a": "from begins"})
+        self.assertEqual({}, dict(namespace))
+        self.assertEqual(2, len(namespace.sources))
+        self.assertTrue(all(isinstance(source, NamespaceIndex) for source in namespace.sources))
+        self.assertEqual("second [1, 2] None", eval("b + ' ' + str(a) + ' ' + str(c)", namespace))
+        self.assertEqual(["a", "b", "c"], sorted(key for key in namespace if not key.startswith("__")))
+        with self.assertRaises(NameError):
+            eval("d", namespace)
+
+    def test_indexes_are_reused(self):
+        """Test the index of an unchanged file is opened rather than
+        built again, and a changed file is indexed again."""
+        self.make()
+        indexes = sorted(os.listdir(os.path.join(self.cache_dir, "namespaces")))
+        self.assertEqual(2, len(indexes))
+        self.make()
+        self.assertEqual(indexes, sorted(os.listdir(os.path.join(self.cache_dir, "namespaces"))))
+        with open(self.first, "w") as fout:
+            fout.write("{'a': 'changed'}")
+        self.assertEqual("changed", self.make(namespaces=[self.first])["a"])
+
+    def test_environment_and_unindexable_files(self):
+        """Test the environment is a source and files which aren't pure
+        data are loaded as usual."""
+        code = os.path.join(self.root, "code.py")
+        with open(code, "w") as fout:
+            fout.write("{'d': str(len(b))}")
+        os.environ["AINA_TEST_LAZY"] = "yes"
+        try:
+            namespace = self.make(namespaces=[self.first, code], add_env=True)
+        finally:
+            del os.environ["AINA_TEST_LAZY"]
+        self.assertEqual("5", namespace["d"])
+        self.assertIn(os.environ, namespace.sources)
+        self.assertEqual("first", namespace["b"])
+
+    def test_line_namespace_shares_sources(self):
+        """Test the namespace of each line of `aina stream` can see the
+        lazy values."""
+        namespace = LineNamespace(self.make())
+        namespace.set_line(b"x y\n", 1, 1)
+        self.assertEqual("second x", eval("b + ' ' + fields[0].decode()", namespace))
+
+    def test_builtins_are_found_without_being_kept(self):
+        """Test builtins are returned by `__missing__` rather than
+        through a KeyError, without being added to the namespace, and
+        don't hide the values of the sources."""
+        for namespace in (LazyNamespace({"nr": 12}), LineNamespace({"nr": 12})):
+            self.assertEqual(14, eval("len(str(nr)) + int(nr)", namespace))
+            self.assertIs(len, namespace["len"])
+            self.assertNotIn("len", namespace)
+            with self.assertRaises(KeyError):
+                namespace["undefined_name"]
+        with open(self.first, "w") as fout:
+            fout.write("{'id': 'shadowed'}")
+        namespace = LineNamespace(self.make(namespaces=[self.first]))
+        self.assertEqual("shadowed", eval("id", namespace))
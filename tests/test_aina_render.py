@@ -4,8 +4,12 @@
 """Tests for `aina` package."""
 
 
+import os
+import shutil
+import tempfile
+import logging
 import unittest
-from aina.render import render
+from aina.render import render, render_iter, compile_template, load_template, Template, TRACE
 
 class TestainaRender(unittest.TestCase):
     """Tests for `aina` package."""
@@ -69,3 +73,114 @@ class TestainaRender(unittest.TestCase):
         input = "{%print('hello, world')%}"
         expected = "hello, world\n"
         self.assertEqual(render(input, self.namespace), expected)
+
+    def test_expression_in_statement_output_with_rescan(self):
+        input = "{%print('{{y}}')%}"
+        expected = "foo\n"
+        self.assertEqual(render(input, self.namespace, rescan=True), expected)
+
+    def test_statement_output_not_rescanned_by_default(self):
+        input = "{%print('{{y}}')%}"
+        expected = "{{y}}\n"
+        self.assertEqual(render(input, self.namespace), expected)
+
+    def test_segments_rendered_in_order(self):
+        input = "{{str(x)}}{% x = 5 %}{{str(x)}}"
+        expected = "425"
+        self.assertEqual(render(input, self.namespace), expected)
+
+    def test_compiled_template_is_reused(self):
+        input = "{{y}} and {{str(x)}}"
+        template = compile_template(input)
+        self.assertIs(template, compile_template(input))
+        self.assertEqual(template.render(self.namespace), "foo and 42")
+        self.assertEqual(render(template, {"x": 1, "y": "bar"}), "bar and 1")
+
+    def test_concurrent_renders_capture_their_own_output(self):
+        import threading
+        results = {}
+
+        def worker(n):
+            namespace = {"n": n}
+            results[n] = [
+                render("{% for i in range(50): print(n, end='') %}", namespace)
+                for _ in range(20)
+            ]
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n, outputs in results.items():
+            self.assertEqual(outputs, [str(n) * 50] * 20)
+
+    def test_render_iter_yields_segments_as_evaluated(self):
+        namespace = {"seen": []}
+        chunks = render_iter("a{{seen.append(1) or 'b'}}c{% print('d') %}", namespace)
+        self.assertEqual(next(chunks), "a")
+        self.assertEqual(namespace["seen"], [])
+        self.assertEqual(next(chunks), "b")
+        self.assertEqual(namespace["seen"], [1])
+        self.assertEqual(list(chunks), ["c", "d\n"])
+        self.assertEqual(
+            "".join(render_iter("{% print('{{x}}') %}", {"x": 1}, rescan=True)),
+            "1\n",
+        )
+
+    def test_include(self):
+        directory = tempfile.mkdtemp()
+        try:
+            partial = os.path.join(directory, "partial")
+            with open(partial, "w") as fout:
+                fout.write("[{{y}}{% y = 'bar' %}]")
+            template = Template("{% include 'partial' %} {{y}}", os.path.join(directory, "page"))
+            self.assertEqual(template.render({"y": "foo"}), "[foo] bar")
+            self.assertEqual(
+                render("{% include os.path.join(d, 'partial') %}", {"os": os, "d": directory, "y": 1}),
+                "[1]",
+            )
+            self.assertIs(load_template(partial), load_template(partial))
+
+            first = load_template(partial)
+            with open(partial, "w") as fout:
+                fout.write("changed {{y}}")
+            self.assertIsNot(first, load_template(partial))
+            self.assertEqual(template.render({"y": "foo"}), "changed foo foo")
+        finally:
+            shutil.rmtree(directory)
+
+    def test_include_as_a_name(self):
+        """Test statements which merely start with the name `include`
+        are still executed as statements."""
+        self.assertEqual(render("{% include = 1 %}{{include}}", {}), "1")
+        self.assertEqual(render("{% include = 1 %}{% include += 1 %}{{include}}", {}), "2")
+
+    def test_tags_are_only_logged_when_tracing(self):
+        """Test the message for each tag is logged at `TRACE`, and not
+        even formatted when that level is disabled."""
+        class Tag(str):
+            formatted = 0
+            def __format__(self, spec):
+                Tag.formatted += 1
+                return str.__format__(self, spec)
+        template = Template("{{x}} {% print(y) %}")
+        template.segments = [
+            (kind, value, Tag(tag) if tag is not None else tag)
+            for kind, value, tag in template.segments
+        ]
+        log = logging.getLogger("aina.render")
+        level = log.level
+        try:
+            log.setLevel(logging.DEBUG)
+            self.assertEqual(template.render(self.namespace), "42 foo\n")
+            self.assertEqual(0, Tag.formatted)
+            with self.assertLogs("aina.render", TRACE) as logs:
+                self.assertEqual(template.render(self.namespace, rescan=True), "42 foo\n")
+        finally:
+            log.setLevel(level)
+        self.assertEqual(2, Tag.formatted)
+        self.assertEqual(
+            ["TRACE:aina.render:Found tag {% print(y) %}", "TRACE:aina.render:Found tag {{x}}"],
+            sorted(logs.output),
+        )
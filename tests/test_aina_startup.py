@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the time it takes `aina` to start."""
+import sys
+import subprocess
+import unittest
+
+# Modules which only some subcommands (or options) need, so they
+# mustn't be imported just to start the CLI
+DEFERRED = (
+    "aina.deps",
+    "aina.doc",
+    "aina.follow",
+    "aina.hooks",
+    "aina.namespace",
+    "aina.profiling",
+    "aina.stream",
+    "aina.watch",
+    "asyncio",
+    "cProfile",
+    "glob",
+    "hashlib",
+    "json",
+    "locale",
+    "logging.config",
+    "mmap",
+    "multiprocessing",
+    "pathlib",
+    "pickle",
+    "sqlite3",
+    "tempfile",
+    "urllib.request",
+)
+
+# Microseconds, as reported by `python -X importtime`, which importing
+# the CLI may take on top of importing click
+BUDGET = 50000
+
+
+def importtime(module):
+    """Return the cumulative time, in microseconds, taken to import
+    each module imported by `import module` in a new interpreter."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        try:
+            times.setdefault(name.strip(), int(cumulative))
+        except ValueError:
+            # The header
+            continue
+    return times
+
+
+class TestainaStartup(unittest.TestCase):
+    """Tests for the modules imported when `aina` starts."""
+
+    def test_subcommand_modules_are_deferred(self):
+        """Test that the modules needed by only some subcommands are
+        not imported up front."""
+        times = importtime("aina.aina")
+        self.assertIn("aina.aina", times)
+        for module in DEFERRED:
+            self.assertNotIn(module, times)
+
+    def test_library_does_not_import_click(self):
+        """Test that `from aina import render` doesn't pay for the CLI."""
+        times = importtime("aina")
+        self.assertNotIn("click", times)
+
+    def test_import_time_budget(self):
+        """Test that importing the CLI, apart from click, stays within
+        `BUDGET`. The best of a few runs is used to leave out noise."""
+        spent = min(
+            times["aina.aina"] - times.get("click", 0)
+            for times in (importtime("aina.aina") for _ in range(5))
+        )
+        self.assertLess(spent, BUDGET)
@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `aina stream` command."""
+import os
+import bz2
+import gzip
+import lzma
 import unittest
 import logging
 from aina.aina import cli
+from aina.stream import Pipeline
 from click.testing import CliRunner
 
 
@@ -101,9 +106,392 @@ class TestainaStream(unittest.TestCase):
         expected = "foobar\n"
         self.assertEqual(expected, result.output)
 
+    def test_tests_with_comments(self):
+        """Test that tests ending with a comment are still combined."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--tests", "nr > 1 # not the first",
+                "--tests", "nr < 4  # nor the last",
+                "--templates", "{{line.strip()}}",
+            ),
+            input="a\nb\nc\nd\n",
+        )
+        self.assertEqual("b\nc\n", result.output)
+
     def test_help_menu(self):
         """Test the CLI."""
         runner = CliRunner()
         help_result = runner.invoke(cli, ['stream', '--help'])
         self.assertEqual(help_result.exit_code, 0)
         self.assertIn('Show this message and exit.', help_result.output)
+
+    def test_hooks_can_be_files(self):
+        """Test that hooks which name a file execute that file."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open("count.py", "w") as fout:
+                fout.write("count += 1\n")
+            result = runner.invoke(
+                cli,
+                args=(
+                    "stream",
+                    "--begins", "count = 0",
+                    "--begin-lines", "count.py",
+                    "--ends", "print(count)",
+                ),
+                input="foo\nbar\nbaz\n",
+            )
+        expected = "3\n"
+        self.assertEqual(expected, result.output)
+
+    def test_fast_path_tests(self):
+        """Test that substring and regex tests, which are evaluated
+        against the raw line, agree with the full evaluation."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--begins", "import re",
+                "--tests", "'error' in line.lower()",
+                "--tests", "'skip' not in line",
+                "--tests", "re.search(r'\\d+', line)",
+                "--tests", "len(line) > 10",
+                "--templates", "{{fnr}}: {{line}}",
+            ),
+            input="Error 1\nERROR: 42 failed\nerror 3 skip this\nan error\nok 5\n",
+        )
+        expected = "2: ERROR: 42 failed\n"
+        self.assertEqual(expected, result.output)
+
+    def test_end_lines_see_lines_rejected_by_fast_path(self):
+        """Test `--end-lines` still run for lines rejected without
+        building the namespace."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--tests", "'bar' in line",
+                "--end-lines", "print(nr, line.strip())",
+            ),
+            input="foo\nbar\n",
+        )
+        expected = "1 foo\n2 bar\n"
+        self.assertEqual(expected, result.output)
+
+    def test_ends_see_last_line_rejected_by_fast_path(self):
+        """Test `--end-files` and `--ends` see the last line and its
+        numbers even when the prefilter rejected it."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--tests", "'x' in line",
+                "--end-files", "print('EF', nr, fnr, line.strip())",
+                "--ends", "print('E', nr, fnr, line.strip())",
+            ),
+            input="x\ny\nz\n",
+        )
+        expected = "EF 3 3 z\nE 3 3 z\n"
+        self.assertEqual(expected, result.output)
+
+    def test_output_to_stdout(self):
+        """Test that `--output -` writes results straight to stdout."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--output", "-",
+                "--flush-lines", "1",
+                "--templates", "{{line}}",
+            ),
+            input="foo\nbar\n",
+        )
+        expected = "foo\nbar\n"
+        self.assertEqual(expected, result.output)
+
+    def test_output_to_file(self):
+        """Test that `--output` writes results to a file, flushed on exit."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            result = runner.invoke(
+                cli,
+                args=(
+                    "stream",
+                    "--output", "out.txt",
+                    "--flush-bytes", "0",
+                    "--templates", "{{nr}} {{line}}",
+                ),
+                input="foo\nbar\n",
+            )
+            with open("out.txt", "r") as fin:
+                contents = fin.read()
+        self.assertEqual("", result.output)
+        self.assertEqual("1 foo\n2 bar\n", contents)
+
+    def test_fields_with_field_sep(self):
+        """Test `fields` and `nf` honor `--field-sep`."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--field-sep", ",",
+                "--templates", "{{nf}} {{fields[1].decode()}}",
+            ),
+            input="a,b,c\nd,e\n",
+        )
+        expected = "3 b\n2 e\n"
+        self.assertEqual(expected, result.output)
+
+    def test_line_values_are_recomputed_for_each_line(self):
+        """Test the lazily computed values never leak from a previous line."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--tests", "nr % 2",
+                "--templates", "{{nf}} {{line.strip()}}",
+            ),
+            input="a b\nc d e\nf g h i\n",
+        )
+        expected = "2 a b\n4 f g h i\n"
+        self.assertEqual(expected, result.output)
+
+    def test_parallel_jobs_keep_order_and_merge_state(self):
+        """Test `--jobs` renders in input order and `--merges` combines
+        the namespaces of the workers."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name in ("a", "b", "c"):
+                with open(name, "w") as fout:
+                    fout.write("".join("{}{}\n".format(name, i) for i in range(20)))
+            result = runner.invoke(
+                cli,
+                args=(
+                    "stream",
+                    "--jobs", "2",
+                    "--chunk-size", "16",
+                    "--begins", "count = 0",
+                    "--begin-lines", "count += 1",
+                    "--tests", "line.endswith('7\\n')",
+                    "--templates", "{{line}}",
+                    "--merges", "count += worker['count']",
+                    "--ends", "print(count)",
+                    "a", "b", "c",
+                ),
+            )
+        expected = "a7\na17\nb7\nb17\nc7\nc17\n6\n"
+        self.assertEqual(expected, result.output)
+
+    def test_parallel_jobs_print_begins_once(self):
+        """Test what `--begins` prints is shown once with `--jobs`,
+        although every task runs it again."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name in ("f", "g", "h"):
+                with open(name, "w") as fout:
+                    fout.write("{}\n".format(name))
+            result = runner.invoke(
+                cli,
+                args=(
+                    "stream",
+                    "--jobs", "2",
+                    "--begins", "print('HEADER')",
+                    "--templates", "{{line.strip()}}",
+                    "f", "g", "h",
+                ),
+            )
+        self.assertEqual("HEADER\nf\ng\nh\n", result.output)
+
+    def test_state_only_holds_what_was_set(self):
+        """Test the state sent back by workers leaves out the values of
+        `--namespaces` unless they were rebound."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open("namespace", "w") as fout:
+                fout.write("{'inventory': {'a': 1}, 'rebound': 1}")
+            with open("f", "w") as fout:
+                fout.write("x\n")
+            pipeline = Pipeline(
+                namespaces=["namespace"],
+                begins=["import re", "count = 0", "rebound = 2"],
+                begin_lines=["count += 1"],
+            )
+            pipeline.begin()
+            pipeline.process_file("f")
+            state = pipeline.state()
+        state.pop("filename")
+        self.assertEqual(
+            {"count": 1, "rebound": 2, "nr": 1, "fnr": 1}, state,
+        )
+
+    def test_memory_mapped_files(self):
+        """Test regular files, which are memory-mapped, give the same
+        results as reading them."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open("first", "w") as fout:
+                fout.write("an error\nfine\nERROR: again\nno newline error")
+            open("empty", "w").close()
+            results = [
+                runner.invoke(
+                    cli,
+                    args=(
+                        "stream",
+                        mmap,
+                        "--output", "-",
+                        "--flush-lines", "1",
+                        "--tests", "'error' in line.lower()",
+                        "--templates", "{{fnr}} {{line.strip()}}",
+                        "--end-files", "print(fnr, line.strip())",
+                        "first", "empty",
+                    ),
+                ).output
+                for mmap in ("--mmap", "--no-mmap")
+            ]
+        expected = "1 an error\n3 ERROR: again\n4 no newline error\n4 no newline error\n4 no newline error\n"
+        self.assertEqual([expected, expected], results)
+
+    @unittest.skipUnless(os.path.isfile("/proc/version"), "needs procfs")
+    def test_memory_mapped_files_of_size_zero(self):
+        """Test files which report a size of 0 but have content, as in
+        procfs, are read rather than memory-mapped."""
+        with open("/proc/version") as fin:
+            expected = fin.read()
+        result = CliRunner().invoke(
+            cli,
+            args=(
+                "stream",
+                "--mmap",
+                "--output", "-",
+                "--templates", "{{line.strip()}}",
+                "/proc/version",
+            ),
+        )
+        self.assertEqual(expected, result.output)
+
+    def test_batches(self):
+        """Test `--batch-size` renders templates once per batch of
+        lines which pass the tests."""
+        runner = CliRunner()
+        result = runner.invoke(
+            cli,
+            args=(
+                "stream",
+                "--batch-size", "2",
+                "--tests", "not line.startswith('#')",
+                "--begins", "total = 0",
+                "--begin-batches", "total += sum(column(1))",
+                "--templates", "{{nb}} {{','.join(line.strip() for line in lines)}}",
+                "--ends", "print(total)",
+            ),
+            input="a 1\n# b 2\nc 3\nd 4\ne 5\nf 6\n",
+        )
+        expected = "2 a 1,c 3\n2 d 4,e 5\n1 f 6\n19.0\n"
+        self.assertEqual(expected, result.output)
+
+    def test_profile(self):
+        """Test `--profile` doesn't change the results and reports the
+        calls of each hook, test and template on stderr."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            result = runner.invoke(
+                cli,
+                args=(
+                    "stream",
+                    "--profile",
+                    "--profile-stats", "stats",
+                    "--output", "-",
+                    "--flush-lines", "1",
+                    "--tests", "'bar' in line",
+                    "--tests", "nr > 1",
+                    "--begin-lines", "pass",
+                    "--templates", "{{line.strip()}}",
+                ),
+                input="bar\nfoo\nbar\n",
+            )
+            self.assertTrue(os.path.getsize("stats"))
+        self.assertEqual("bar\n", result.stdout)
+        calls = dict(
+            ((line[:16].strip(), line[17:57].strip()), int(line[57:68]))
+            for line in result.stderr.splitlines()[1:-1]
+        )
+        self.assertEqual(3, calls["--tests", "'bar' in line"])
+        self.assertEqual(2, calls["--tests", "nr > 1"])
+        self.assertEqual(1, calls["--begin-lines", "pass"])
+        self.assertEqual(1, calls["--templates", "{{line.strip()}}"])
+        self.assertEqual(3, calls["input", "read"])
+        self.assertEqual(1, calls["output", "emit"])
+
+    def test_trace(self):
+        """Test nothing but the results is logged by default and
+        `--trace` logs every line, template and tag."""
+        runner = CliRunner()
+        args = ("stream", "--templates", "{% print(1) %}{{line.strip()}}")
+        result = runner.invoke(cli, args=args, input="foo\n")
+        self.assertEqual("1\nfoo\n", result.output)
+
+        logging.getLogger("").handlers = []
+        result = runner.invoke(cli, args=args + ("--trace",), input="foo\n")
+        for message in (
+                "Got line: b'foo\\n'",
+                "Rendering template: {% print(1) %}{{line.strip()}}",
+                "Found tag {% print(1) %}",
+                "Found tag {{line.strip()}}",
+                "Result: 1\nfoo",
+            ):
+            self.assertIn(message + "\n", result.output)
+        self.assertTrue(result.output.endswith("Result: 1\nfoo\n1\nfoo\n"))
+
+    def test_compressed_input(self):
+        """Test gzip, bzip2 and xz input, including stdin and gzip
+        files of several members, is decompressed unless
+        `--no-decompress` is given."""
+        text = "".join("line {}\n".format(nr) for nr in range(1000)).encode()
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open("log.gz", "wb") as fout:
+                fout.write(gzip.compress(text[:500]) + gzip.compress(text[500:]))
+            with open("log.bz2", "wb") as fout:
+                fout.write(bz2.compress(text))
+            with open("log.xz", "wb") as fout:
+                fout.write(lzma.compress(text))
+            for args in ((), ("--decompress-thread",), ("--jobs", "2", "--chunk-size", "100")):
+                result = runner.invoke(
+                    cli,
+                    args=(
+                        "stream",
+                        "--output", "-",
+                        "--flush-lines", "1",
+                        "--tests", "line.endswith('99\\n')",
+                        "--templates", "{{line.strip()}}",
+                        "--end-files", "print(fnr)",
+                        "log.gz", "log.bz2", "log.xz",
+                    ) + args,
+                )
+                matches = "".join("line {}\n".format(nr) for nr in range(99, 1000, 100))
+                if "--jobs" in args:
+                    # What a worker printed comes before its results
+                    expected = "1000\n" + matches
+                else:
+                    expected = matches + "1000\n"
+                self.assertEqual(expected * 3, result.output)
+            result = runner.invoke(
+                cli,
+                args=("stream", "--output", "-", "--end-files", "print(fnr)"),
+                input=gzip.compress(text),
+            )
+            self.assertEqual("1000\n", result.output)
+            result = runner.invoke(
+                cli,
+                args=("stream", "--no-decompress", "--end-files", "print(b'line' in fields)", "log.xz"),
+            )
+            self.assertEqual("False\n", result.output)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `aina.watch` module."""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from aina.watch import InotifyWatcher, PollingWatcher
+
+
+class WatcherTests(object):
+    """Tests shared by every kind of watcher."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "child"))
+        for name in ("first", os.path.join("child", "nested")):
+            with open(os.path.join(self.root, name), "w") as fout:
+                fout.write("{{test}}")
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.root)
+
+    def test_reports_changed_files(self):
+        """Test that only the files which were written are reported."""
+        watcher = self.Watcher(self.root, recursive=True, interval=0.01)
+        try:
+            path = os.path.join(self.root, "child", "nested")
+            with open(path, "w") as fout:
+                fout.write("changed {{test}}")
+            self.assertEqual({path}, watcher.wait(timeout=2))
+            self.assertEqual(set(), watcher.wait(timeout=0.05))
+        finally:
+            watcher.close()
+
+    def test_reports_new_directories(self):
+        """Test that new directories are reported when recursive."""
+        watcher = self.Watcher(self.root, recursive=True, interval=0.01)
+        try:
+            path = os.path.join(self.root, "new")
+            os.mkdir(path)
+            self.assertIn(path, watcher.wait(timeout=2))
+        finally:
+            watcher.close()
+
+    def test_single_file(self):
+        """Test that watching a file ignores its siblings."""
+        path = os.path.join(self.root, "first")
+        watcher = self.Watcher(path, interval=0.01)
+        try:
+            with open(os.path.join(self.root, "sibling"), "w") as fout:
+                fout.write("ignored")
+            with open(path, "w") as fout:
+                fout.write("changed {{test}}")
+            self.assertEqual({path}, watcher.wait(timeout=2))
+        finally:
+            watcher.close()
+
+
+    def test_watch_files_outside_of_tree(self):
+        """Test that extra files are reported wherever they are."""
+        outside = tempfile.mkdtemp()
+        try:
+            path = os.path.join(outside, "namespace")
+            with open(path, "w") as fout:
+                fout.write("{}")
+            watcher = self.Watcher(self.root, interval=0.01)
+            try:
+                watcher.watch_files([path])
+                with open(os.path.join(outside, "ignored"), "w") as fout:
+                    fout.write("ignored")
+                with open(path, "w") as fout:
+                    fout.write("{'test': 'foo'}")
+                self.assertEqual({path}, watcher.wait(timeout=2))
+            finally:
+                watcher.close()
+        finally:
+            shutil.rmtree(outside)
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+    """Tests for `aina.watch.InotifyWatcher`."""
+    Watcher = InotifyWatcher
+
+
+class TestPollingWatcher(WatcherTests, unittest.TestCase):
+    """Tests for `aina.watch.PollingWatcher`."""
+    Watcher = PollingWatcher